@@ -7,23 +7,30 @@ https://github.com/dangom/dac2bids/blob/master/dac2bids.py
 @author: Marcel Zwiers
 """
 import copy
+import csv
 import re
 import logging
 import tempfile
 import tarfile
 import zipfile
 import json
+import os
 import shutil
+from datetime import datetime
 from functools import lru_cache
 from pydicom import dcmread, fileset, datadict
 from nibabel.parrec import parse_PAR_header
 from distutils.dir_util import copy_tree
-from typing import Union, List, Tuple
+from typing import Union, List, Tuple, Iterator
 from pathlib import Path
 try:
     from bidscoin import bidscoin, dicomsort
 except ImportError:
     import bidscoin, dicomsort  # This should work if bidscoin was not pip-installed
+try:
+    import orjson                   # The (much) faster orjson library is used for the json sidecar files if it is installed
+except ImportError:
+    orjson = None
 from ruamel.yaml import YAML
 yaml = YAML()
 
@@ -342,7 +349,7 @@ def is_dicomfile(file: Path) -> bool:
                 return True
         LOGGER.debug(f"Reading non-standard DICOM file: {file}")
         if file.suffix.lower() in ('.ima','.dcm','.dicm','.dicom',''):           # Avoid memory problems when reading a very large (e.g. EEG) source file
-            dicomdata = dcmread(file, force=True)               # The DICM tag may be missing for anonymized DICOM files
+            dicomdata = dcmread(file, force=True, stop_before_pixels=True)  # The DICM tag may be missing for anonymized DICOM files. NB: Only the Modality is checked, so the pixel data is not needed
             return 'Modality' in dicomdata
         # else:
         #     dicomdata = dcmread(file)                         # NB: Raises an error for non-DICOM files
@@ -432,6 +439,91 @@ def get_parfiles(folder: Path) -> List[Path]:
     return parfiles
 
 
+def scandir_recursive(folder: Union[str, Path]) -> Iterator[os.DirEntry]:
+    """
+    Recursively yields the os.DirEntry objects of all files in folder. This is faster than Path.rglob() because the
+    cached file type information of the DirEntry objects is used. NB: Symlinked sub-folders are not followed
+
+    :param folder:  The full pathname of the folder that is searched
+    :return:        A generator of the DirEntry objects of all files in folder and its sub-folders
+    """
+
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scandir_recursive(entry.path)
+            else:
+                yield entry
+
+
+def _jsondefault(obj):
+    """Converts the objects that orjson cannot serialize natively, i.e. float subclasses such as the ScalarFloat values of a (round-trip loaded) bidsmap"""
+
+    if isinstance(obj, float):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def loads_json(jsonbytes: bytes) -> dict:
+    """
+    Parses json-data, using orjson if it is installed
+
+    :param jsonbytes:   The (utf-8 encoded) json-data
+    :return:            The parsed data
+    """
+
+    if orjson:
+        return orjson.loads(jsonbytes)
+    return json.loads(jsonbytes)
+
+
+def dumps_json(jsondata: dict) -> bytes:
+    """
+    Serializes data to json, using orjson if it is installed. NB: orjson only supports an indentation of two spaces, so
+    the same indentation is used when falling back to the json library
+
+    :param jsondata:    The data that is serialized
+    :return:            The (utf-8 encoded) json-data
+    """
+
+    if orjson:
+        return orjson.dumps(jsondata, default=_jsondefault, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(jsondata, indent=2).encode('utf-8')
+
+
+def load_json(jsonfile: Path) -> dict:
+    """
+    Reads the data from a json (sidecar) file, using orjson if it is installed
+
+    :param jsonfile:    The full pathname of the json-file
+    :return:            The json data
+    """
+
+    return loads_json(jsonfile.read_bytes())
+
+
+def save_json(jsondata: dict, jsonfile: Path) -> None:
+    """
+    Writes data to a json (sidecar) file, using orjson if it is installed. The data is first written to a temporary
+    file that then replaces the json-file, so that the json-file is never left half-written (e.g. after a crash). The
+    file permissions of an existing json-file are kept
+
+    :param jsondata:    The data that is written to disk
+    :param jsonfile:    The full pathname of the json-file
+    :return:
+    """
+
+    tmpfile = jsonfile.with_name(jsonfile.name + '.tmp')
+    try:
+        tmpfile.write_bytes(dumps_json(jsondata))
+        if jsonfile.is_file():
+            shutil.copymode(jsonfile, tmpfile)
+        os.replace(tmpfile, jsonfile)
+    except BaseException:                   # NB: Also clean up when interrupted (KeyboardInterrupt)
+        tmpfile.unlink(missing_ok=True)
+        raise
+
+
 def get_datasource(session: Path, plugins: dict, recurse: int=2) -> DataSource:
     """Gets a data source from the session inputfolder and its subfolders"""
 
@@ -503,7 +595,7 @@ def get_dicomfield(tagname: str, dicomfile: Path) -> Union[str, int]:
     else:
         try:
             if dicomfile != _DICOMFILE_CACHE:
-                dicomdata = dcmread(dicomfile, force=True)          # The DICM tag may be missing for anonymized DICOM files
+                dicomdata = dcmread(dicomfile, force=True)          # The DICM tag may be missing for anonymized DICOM files. NB: Read all, i.e. also the attributes after the pixel data (e.g. private (7FE1,xxxx) tags)
                 _DICOMDICT_CACHE = dicomdata
                 _DICOMFILE_CACHE = dicomfile
             else:
@@ -546,6 +638,60 @@ def get_dicomfield(tagname: str, dicomfile: Path) -> Union[str, int]:
         return str(value)               # If it's a MultiValue type then flatten it
 
 
+def get_personalfields(dicomfile: Path) -> dict:
+    """
+    Reads the personal data fields from a DICOM header. Only these (standard) fields are decoded, i.e. using the
+    specific_tags of dcmread, so missing fields (e.g. in anonymized headers) are not searched for any further
+
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            The {'PatientAge': value, 'PatientSex': value, 'PatientSize': value, 'PatientWeight': value} dictionary
+    """
+
+    tagnames = ['PatientAge', 'PatientSex', 'PatientSize', 'PatientWeight']
+    try:
+        dicomdata = dcmread(dicomfile, force=True, stop_before_pixels=True, specific_tags=tagnames)
+    except Exception as dicomerror:
+        LOGGER.warning(f"Could not read {tagnames} from {dicomfile}\n{dicomerror}")
+        dicomdata = None
+
+    # Cast the dicom datatype to int or str (i.e. the same as get_dicomfield)
+    dicomfields = {}
+    for tagname in tagnames:
+        value = getattr(dicomdata, tagname, '')
+        if isinstance(value, int):
+            dicomfields[tagname] = int(value)
+        elif value is None:
+            dicomfields[tagname] = ''
+        else:
+            dicomfields[tagname] = str(value)
+
+    return dicomfields
+
+
+# The common date/time formats of the (dcm2niix) AcquisitionTime and (PAR) exam_date values, in order of likelihood
+_TIME_FORMATS = ('%H:%M:%S.%f', '%H:%M:%S', '%H%M%S.%f', '%H%M%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y.%m.%d / %H:%M:%S')
+
+
+@lru_cache(maxsize=4096)
+def parse_datetime(timestr: str) -> datetime:
+    """
+    Parses a (DICOM or dcm2niix) date/time string. The common time formats are parsed with strptime, anything else is
+    left to the (much slower) dateutil parser. The results are cached, as the same strings occur in many sidecar files
+
+    :param timestr: The date/time string, e.g. '14:52:36.742500', '145236.742500' or '2019.05.28 / 14:52:36'
+    :return:        The parsed datetime object (of which only the time is reliable if timestr has no date)
+    """
+
+    for timeformat in _TIME_FORMATS:
+        try:
+            return datetime.strptime(timestr, timeformat)
+        except ValueError:
+            pass
+
+    import dateutil.parser                  # NB: Only imported when needed (slow import)
+    return dateutil.parser.parse(timestr)
+
+
 # Profiling shows this is currently the most expensive function, so therefore the (primitive but effective) cache optimization
 _TWIXHDR_CACHE  = None
 _TWIXFILE_CACHE = None
@@ -1247,6 +1393,13 @@ def update_bidsmap(bidsmap: dict, source_datatype: str, run: dict, clean: bool=T
         LOGGER.exception(f"Number of runs in bidsmap['{dataformat}'] changed unexpectedly: {num_runs_in} -> {num_runs_out}")
 
 
+@lru_cache(maxsize=None)
+def _compile_pattern(pattern: str) -> re.Pattern:
+    """Compiles a bidsmap regular expression pattern only once (the re-module cache is too small for large bidsmaps)"""
+
+    return re.compile(pattern)
+
+
 def match_runvalue(attribute, pattern) -> bool:
     """
     Match the value items with the attribute string using regexp. If both attribute
@@ -1281,7 +1434,7 @@ def match_runvalue(attribute, pattern) -> bool:
 
     # See if the pattern matches the source attribute
     try:
-        match = re.fullmatch(pattern, attribute)
+        match = _compile_pattern(pattern).fullmatch(attribute)
     except re.error as patternerror:
         LOGGER.error(f"Cannot compile regular expression pattern '{pattern}': {patternerror}")
         match = None
@@ -1675,6 +1828,35 @@ def increment_runindex(bidsfolder: Path, bidsname: str, ext: str='.*') -> Union[
     return bidsname
 
 
+def update_scans_tsv(scans_tsv: Path, acq_times: dict) -> None:
+    """
+    Adds or updates the acquisition times of the (new) scans in the scans.tsv file. The rows are sorted by acq_time
+    (rows without an acquisition time last) and then by filename, and any other (user-added) columns are kept
+
+    :param scans_tsv:   The full pathname of the scans.tsv file
+    :param acq_times:   The {filename: acq_time} dictionary of the scans, with filename relative to the session folder
+    :return:
+    """
+
+    scans_columns = ['filename', 'acq_time']
+    scans_table   = {}                                              # The scans.tsv rows, keyed by filename
+    if scans_tsv.is_file():
+        with scans_tsv.open('r', newline='', encoding='utf-8') as tsv_fid:
+            reader        = csv.DictReader(tsv_fid, delimiter='\t')
+            scans_table   = {row['filename']: row for row in reader}
+            scans_columns = reader.fieldnames or scans_columns
+        if 'acq_time' not in scans_columns:
+            scans_columns.append('acq_time')
+    for filename, acq_time in acq_times.items():
+        scans_table.setdefault(filename, {'filename': filename})['acq_time'] = acq_time or 'n/a'
+
+    LOGGER.info(f"Writing acquisition time data to: {scans_tsv}")
+    with scans_tsv.open('w', newline='', encoding='utf-8') as tsv_fid:
+        writer = csv.DictWriter(tsv_fid, fieldnames=scans_columns, restval='n/a', delimiter='\t', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(sorted(scans_table.values(), key=lambda row: (row.get('acq_time') in (None, '', 'n/a'), row.get('acq_time') or '', row['filename'])))
+
+
 def copymetadata(metasource: Path, metatarget: Path, extensions: list) -> dict:
     """
     Copies over or, in case of json-files, returns the content of 'metasource' data files
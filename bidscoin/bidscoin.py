@@ -15,6 +15,7 @@ import textwrap
 import tarfile
 import shutil
 import sys
+import os
 import logging
 import coloredlogs
 import inspect
@@ -24,7 +25,7 @@ import json
 from PyQt5.QtWidgets import QApplication, QPushButton
 from tqdm import tqdm
 from pathlib import Path
-from functools import lru_cache
+from functools import lru_cache, partial
 from importlib.util import spec_from_file_location, module_from_spec
 from importlib.metadata import entry_points
 from typing import Tuple, Union, List
@@ -177,6 +178,40 @@ def run_command(command: str) -> bool:
 
     LOGGER.info(f"Running: {command}")
     process = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)          # TODO: investigate shell=False and capture_output=True for python 3.7
+
+    return _check_process(command, process)
+
+
+def run_commands(commands: List[str]) -> List[bool]:
+    """
+    Runs independent commands in a shell, like run_command(), but concurrently in a pool of threads (i.e. each thread
+    just waits for its subprocess). All logging is done in the calling thread and in the order of the commands
+
+    :param commands:    The commands that are executed
+    :return:            For each command: True if it was successfully executed (no errors), False otherwise
+    """
+
+    for command in commands:
+        LOGGER.info(f"Running: {command}")
+    if len(commands) > 1:
+        from concurrent.futures import ThreadPoolExecutor       # NB: Only imported when needed
+        with ThreadPoolExecutor(max_workers=min(len(commands), os.cpu_count() or 1)) as executor:
+            processes = list(executor.map(partial(subprocess.run, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE), commands))
+    else:
+        processes = [subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) for command in commands]
+
+    return [_check_process(command, process) for command, process in zip(commands, processes)]
+
+
+def _check_process(command: str, process: subprocess.CompletedProcess) -> bool:
+    """
+    Logs the output of a finished command
+
+    :param command: The command that was executed
+    :param process: The finished process of the command
+    :return:        True if the command was successfully executed (no errors), False otherwise
+    """
+
     if process.stderr.decode('utf-8') or process.returncode != 0:
         LOGGER.error(f"Failed to run:\n{command}\nErrorcode {process.returncode}:\n{process.stdout.decode('utf-8')}\n{process.stderr.decode('utf-8')}")
         return False
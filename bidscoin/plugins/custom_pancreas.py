@@ -18,33 +18,84 @@ NOTE
 @updated: 2022-04-22 by Tikahari Khanal
 """
 
+import copy
 import logging
-import dateutil.parser
-import pandas as pd
-import json
+import os
+import sys
+from fnmatch import fnmatch
+from functools import lru_cache, partial
+from itertools import zip_longest
+from types import MappingProxyType
+from typing import Union, Tuple
 from pathlib import Path
 from ruamel.yaml import YAML
-from bidscoin.bids import *
+from bidscoin.bids import add_prefix, check_bidsmap, cleanup_value, get_bidsvalue, get_run_
 from bidscoin.bids import entities as default_entities
 try:
-    from bidscoin import bidscoin, bids, physio
+    from bidscoin import bidscoin, bids
 except ImportError:
-    import bidscoin, bids, physio     # This should work if bidscoin was not pip-installed
-
+    import bidscoin, bids             # This should work if bidscoin was not pip-installed
 LOGGER = logging.getLogger(__name__)
-yaml = YAML()
+yaml = YAML(typ='safe')             # The bidsmaps are only read (never round-tripped) here, so use the fast (libyaml-based) safe loader
 
 
 # Define BIDScoin datatypes
 bidscoindatatypes = ('fmap', 'anat', 'func', 'perf', 'dwi', 'pet', 'meg', 'eeg', 'ieeg', 'beh')           # NB: get_matching_run() uses this order to search for a match. TODO: sync with the modalities.yaml schema
 ignoredatatype    = 'exclude'
 unknowndatatype   = 'extra_data'
+outputexts        = ('.nii.gz', '.nii', '.json', '.bval', '.bvec', '.tsv.gz')                                  # The extensions of the output files of a run
+dataexts          = ('.nii.gz', '.nii', '.tsv.gz')                                                              # The extensions of the data files that come with a json sidecar file
+ageunits          = {'D': 365.2524, 'W': 52.1775, 'M': 12, 'Y': 1}                                              # The number of DICOM PatientAge units (days, weeks, months, years) per year
 
 # Define the default paths
-schema_folder     = Path(__file__).parent/'schema'
-heuristics_folder = Path(__file__).parent/'heuristics'
+schema_folder     = Path(__file__).parents[1]/'schema'
+heuristics_folder = Path(__file__).parents[1]/'heuristics'
 bidsmap_template  = heuristics_folder/'bidsmap_template.yaml'
 
+
+def _freeze(obj):
+    """
+    Recursively converts dicts to read-only mappings and lists to tuples, and interns all strings
+
+    :param obj: The (nested) data structure that is frozen
+    :return:    The frozen data structure
+    """
+
+    if isinstance(obj, dict):
+        return MappingProxyType({_freeze(key): _freeze(val) for key, val in obj.items()})
+    if isinstance(obj, list):
+        return tuple(_freeze(item) for item in obj)
+    if isinstance(obj, str):
+        return sys.intern(obj)
+
+    return obj
+
+
+def _intern_keys(obj):
+    """
+    Recursively interns all dictionary keys (e.g. of a freshly parsed bidsmap), so that the many lookups of the same keys
+    ('bids', 'suffix', 'attributes', etc) can be resolved by identity instead of by string comparison
+
+    :param obj: The (nested) data structure of which the dictionary keys are interned
+    :return:    The same data structure with interned keys
+    """
+
+    if isinstance(obj, dict):
+        return {sys.intern(key) if isinstance(key, str) else key: _intern_keys(val) for key, val in obj.items()}
+    if isinstance(obj, list):
+        return [_intern_keys(item) for item in obj]
+
+    return obj
+
+
+# The entity groups that are shared by multiple typegroups (read-only, so they can safely be referenced more than once)
+_ENT_TASK       = MappingProxyType({"subject": "required", "session": "optional", "task": "required", "acquisition": "optional", "run": "optional"})
+_ENT_ACQ        = MappingProxyType({"subject": "required", "session": "optional", "acquisition": "optional"})
+_ENT_ACQ_SPACE  = MappingProxyType({"subject": "required", "session": "optional", "acquisition": "optional", "space": "optional"})
+_ENT_DWI        = MappingProxyType({"subject": "required", "session": "optional", "acquisition": "optional", "direction": "optional", "run": "optional", "part": "optional"})
+_ENT_PARAMETRIC = MappingProxyType({"subject": "required", "session": "optional", "run": "optional", "acquisition": "optional", "ceagent": "optional", "reconstruction": "optional"})
+_ENT_PERF       = MappingProxyType({"subject": "required", "session": "optional", "acquisition": "optional", "reconstruction": "optional", "direction": "optional", "run": "optional"})
+
 # Read the BIDS schema datatypes and entities
 bidsdatatypes = {
     "dwi": [
@@ -59,14 +110,7 @@ bidsdatatypes = {
                 ".bvec",
                 ".bval"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional",
-                "direction": "optional",
-                "run": "optional",
-                "part": "optional"
-            }
+            "entities": _ENT_DWI
         },
         {
             "suffixes": [
@@ -77,14 +121,7 @@ bidsdatatypes = {
                 ".nii",
                 ".json"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional",
-                "direction": "optional",
-                "run": "optional",
-                "part": "optional"
-            }
+            "entities": _ENT_DWI
         }
     ],
     "meg": [
@@ -122,11 +159,7 @@ bidsdatatypes = {
             "extensions": [
                 "*"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional"
-            }
+            "entities": _ENT_ACQ
         },
         {
             "suffixes": [
@@ -151,11 +184,7 @@ bidsdatatypes = {
             "extensions": [
                 ".json"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional"
-            }
+            "entities": _ENT_ACQ
         },
         {
             "suffixes": [
@@ -182,13 +211,7 @@ bidsdatatypes = {
                 ".json",
                 ".tsv"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "task": "required",
-                "acquisition": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_TASK
         },
         {
             "suffixes": [
@@ -197,11 +220,7 @@ bidsdatatypes = {
             "extensions": [
                 ".jpg"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional"
-            }
+            "entities": _ENT_ACQ
         }
     ],
     "beh": [
@@ -232,13 +251,7 @@ bidsdatatypes = {
                 ".tsv",
                 ".json"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "task": "required",
-                "acquisition": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_TASK
         }
     ],
     "fmap": [
@@ -383,14 +396,7 @@ bidsdatatypes = {
                 ".nii",
                 ".json"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "run": "optional",
-                "acquisition": "optional",
-                "ceagent": "optional",
-                "reconstruction": "optional"
-            }
+            "entities": _ENT_PARAMETRIC
         }
     ],
     "pet": [
@@ -464,13 +470,7 @@ bidsdatatypes = {
                 ".fdt",
                 ".nwb"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "task": "required",
-                "acquisition": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_TASK
         },
         {
             "suffixes": [
@@ -480,13 +480,7 @@ bidsdatatypes = {
                 ".json",
                 ".tsv"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "task": "required",
-                "acquisition": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_TASK
         },
         {
             "suffixes": [
@@ -495,12 +489,7 @@ bidsdatatypes = {
             "extensions": [
                 ".json"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional",
-                "space": "optional"
-            }
+            "entities": _ENT_ACQ_SPACE
         },
         {
             "suffixes": [
@@ -510,12 +499,7 @@ bidsdatatypes = {
                 ".json",
                 ".tsv"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional",
-                "space": "optional"
-            }
+            "entities": _ENT_ACQ_SPACE
         },
         {
             "suffixes": [
@@ -525,13 +509,7 @@ bidsdatatypes = {
                 ".json",
                 ".tsv"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "task": "required",
-                "acquisition": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_TASK
         },
         {
             "suffixes": [
@@ -540,11 +518,7 @@ bidsdatatypes = {
             "extensions": [
                 ".jpg"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional"
-            }
+            "entities": _ENT_ACQ
         }
     ],
     "perf": [
@@ -558,14 +532,7 @@ bidsdatatypes = {
                 ".nii",
                 ".json"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional",
-                "reconstruction": "optional",
-                "direction": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_PERF
         },
         {
             "suffixes": [
@@ -575,14 +542,7 @@ bidsdatatypes = {
                 ".tsv",
                 ".json"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional",
-                "reconstruction": "optional",
-                "direction": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_PERF
         },
         {
             "suffixes": [
@@ -657,14 +617,7 @@ bidsdatatypes = {
                 ".nii",
                 ".json"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "run": "optional",
-                "acquisition": "optional",
-                "ceagent": "optional",
-                "reconstruction": "optional"
-            }
+            "entities": _ENT_PARAMETRIC
         },
         {
             "suffixes": [
@@ -827,13 +780,7 @@ bidsdatatypes = {
                 ".fdt",
                 ".bdf"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "task": "required",
-                "acquisition": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_TASK
         },
         {
             "suffixes": [
@@ -843,13 +790,7 @@ bidsdatatypes = {
                 ".json",
                 ".tsv"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "task": "required",
-                "acquisition": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_TASK
         },
         {
             "suffixes": [
@@ -858,12 +799,7 @@ bidsdatatypes = {
             "extensions": [
                 ".json"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional",
-                "space": "optional"
-            }
+            "entities": _ENT_ACQ_SPACE
         },
         {
             "suffixes": [
@@ -873,12 +809,7 @@ bidsdatatypes = {
                 ".json",
                 ".tsv"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional",
-                "space": "optional"
-            }
+            "entities": _ENT_ACQ_SPACE
         },
         {
             "suffixes": [
@@ -888,13 +819,7 @@ bidsdatatypes = {
                 ".json",
                 ".tsv"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "task": "required",
-                "acquisition": "optional",
-                "run": "optional"
-            }
+            "entities": _ENT_TASK
         },
         {
             "suffixes": [
@@ -903,11 +828,7 @@ bidsdatatypes = {
             "extensions": [
                 ".jpg"
             ],
-            "entities": {
-                "subject": "required",
-                "session": "optional",
-                "acquisition": "optional"
-            }
+            "entities": _ENT_ACQ
         }
     ],
     "func": [
@@ -998,6 +919,7 @@ bidsdatatypes = {
         }
     ]
 }
+bidsdatatypes = _freeze(bidsdatatypes)                                         # Read-only and shared by all runs, i.e. safe to cache
 
 entities = {
     "subject": {
@@ -1146,6 +1068,205 @@ entities = {
     }
 }
 
+# Index the typegroups by suffix (in bidscoindatatypes order), i.e. suffix -> ((datatype, typegroup index, required entity keys, optional entity keys, ordered entity keys), ...). NB: The sub/ses keys are left out
+_SUFFIX_INDEX = {}
+for _datatype in bidscoindatatypes:
+    for _index, _typegroup in enumerate(bidsdatatypes.get(_datatype, ())):
+        _required = frozenset(entities[name]['entity'] for name, role in _typegroup['entities'].items() if role == 'required') - {'sub','ses'}
+        _optional = frozenset(entities[name]['entity'] for name, role in _typegroup['entities'].items() if role != 'required') - {'sub','ses'}
+        _ordered  = tuple(entities[name]['entity'] for name in _typegroup['entities'] if entities[name]['entity'] not in ('sub','ses'))
+        for _suffix in _typegroup['suffixes']:
+            _SUFFIX_INDEX.setdefault(_suffix, []).append((_datatype, _index, _required, _optional, _ordered))
+_SUFFIX_INDEX = {_suffix: tuple(_items) for _suffix, _items in _SUFFIX_INDEX.items()}
+
+# The position of the entity keys in the bidsnames and the entity keys of the BIDS standard
+_ENTITY_ORDER        = {entity['entity']: index for index, entity in enumerate(entities.values())}
+_DEFAULT_ENTITY_KEYS = frozenset(entity['entity'] for entity in default_entities.values())
+
+
+def get_datatype(datatype: str) -> tuple:
+    """
+    Gets the (frozen) typegroups of a BIDS datatype
+
+    :param datatype:    The BIDS datatype, e.g. 'anat'
+    :return:            The typegroups with the suffixes, extensions and entities of the datatype or () if the datatype is unknown
+    """
+
+    return bidsdatatypes.get(datatype, ())
+
+
+def lookup_suffix(suffix: str, datatype: str='') -> Union[tuple, None]:
+    """
+    Looks up the BIDS typegroup of a suffix using the suffix index (instead of searching through all bidsdatatypes)
+
+    :param suffix:      The BIDS suffix, e.g. 'T1w'
+    :param datatype:    The BIDS datatype of the suffix, e.g. 'anat'. If empty, the first datatype in bidscoindatatypes with the suffix is taken
+    :return:            A (datatype, typegroup index, required entity keys, optional entity keys, ordered entity keys) tuple or None if the suffix is not found
+    """
+
+    for item in _SUFFIX_INDEX.get(suffix, ()):
+        if not datatype or item[0] == datatype:
+            return item
+
+    return None
+
+
+@lru_cache(maxsize=256)
+def _get_dicomfile(folder: Path, index: int=0) -> Path:
+    """
+    Cached version of bids.get_dicomfile(), so that the (many) files of a series folder are listed and probed only once
+    per series instead of every time that a representative dicom-file of the series is needed
+
+    :param folder:  The full pathname of the series folder
+    :param index:   The index number of the dicom file
+    :return:        The filename of the index-th dicom-file in the folder
+    """
+
+    return bids.get_dicomfile(folder, index)
+
+
+@lru_cache(maxsize=None)
+def _get_derivatives(datatype: str) -> frozenset:
+    """
+    Cached version of bids.get_derivatives() (the BIDS schema is static), which is called for every run
+
+    :param datatype:    The BIDS datatype, e.g. 'anat'
+    :return:            The set of suffixes that are stored in the derivatives folder
+    """
+
+    return frozenset(bids.get_derivatives(datatype))
+
+
+def _get_matchkeys(bidsmap: dict, dataformat: str) -> Union[tuple, None]:
+    """
+    Gets the names of all the attributes that are used to match the source-files with the runs in the bidsmap, including
+    the attributes that are used as dynamic bids values (e.g. `acq: <ProtocolName>`)
+
+    :param bidsmap:     The study bidsmap
+    :param dataformat:  The dataformat of the session, e.g. 'DICOM' or 'PAR'
+    :return:            The sorted attribute names, or None if the runs depend on filesystem properties (i.e. on properties that are unique for each source-file)
+    """
+
+    matchkeys = set()
+    for runs in bidsmap[dataformat].values():
+        if not isinstance(runs, list): continue
+        for run in runs:
+            if any((run.get('filesystem') or {}).values()):
+                return None
+            matchkeys.update(run.get('attributes') or {})
+            for bidsvalue in (run.get('bids') or {}).values():
+                if isinstance(bidsvalue, str) and bidsvalue.startswith('<') and bidsvalue.endswith('>'):
+                    sourcekey = bidsvalue.strip('<>')
+                    if sourcekey.startswith(('SourceFile', 'filepath:', 'filename:')):
+                        return None
+                    if not sourcekey.isdecimal():                   # The <<1>> run-index does not depend on the source-file
+                        matchkeys.add(sourcekey)
+
+    return tuple(sorted(matchkeys))
+
+
+def _match_sourcefile(sourcefile: Path, bidsmap: dict, dataformat: str) -> tuple:
+    """
+    Gets the matching run of a source-file (e.g. in a worker process of the run-matching pool)
+
+    :param sourcefile:  The full pathname of the (representative) source-file of a run
+    :param bidsmap:     The study bidsmap
+    :param dataformat:  The dataformat of the session, e.g. 'DICOM' or 'PAR'
+    :return:            The (run, datatype, index) tuple from bids.get_matching_run()
+    """
+
+    return bids.get_matching_run(sourcefile, bidsmap, dataformat)
+
+
+def _match_sourcefiles(sourcefiles: dict, bidsmap: dict, dataformat: str) -> dict:
+    """
+    Gets the matching runs of the source-files. Source-files with the same attribute values (fingerprints) match with
+    the same run, so only one source-file per fingerprint is matched (in a pool of worker processes if there are more)
+
+    :param sourcefiles: The {source: sourcefile} dictionary of the (representative) source-files of the runs
+    :param bidsmap:     The study bidsmap
+    :param dataformat:  The dataformat of the session, e.g. 'DICOM' or 'PAR'
+    :return:            The {source: (run, datatype, index)} dictionary with the bids.get_matching_run() results
+    """
+
+    matchkeys    = _get_matchkeys(bidsmap, dataformat)
+    fingerprints = {source: (source if matchkeys is None else tuple(bids.get_sourcevalue(key, sourcefile) for key in matchkeys)) for source, sourcefile in sourcefiles.items()}
+    uniquefiles  = {}
+    for source, fingerprint in fingerprints.items():
+        uniquefiles.setdefault(fingerprint, sourcefiles[source])
+
+    # Get the matching runs from the bidsmap (in parallel, the matching of the source-files is independent)
+    matchfile = partial(_match_sourcefile, bidsmap=bidsmap, dataformat=dataformat)
+    if len(uniquefiles) > 1:
+        from concurrent.futures import ProcessPoolExecutor  # NB: Only imported when needed (i.e. not for test() or the bidsmapper)
+        nworkers = min(len(uniquefiles), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=nworkers) as executor:
+            fingerprintmatches = dict(zip(uniquefiles, executor.map(matchfile, uniquefiles.values(), chunksize=-(-len(uniquefiles) // nworkers))))    # NB: Send the bidsmap to each worker only once (per chunk)
+    else:
+        fingerprintmatches = {fingerprint: matchfile(sourcefile) for fingerprint, sourcefile in uniquefiles.items()}
+
+    matches = {}
+    for source, sourcefile in sourcefiles.items():
+        run, datatype, index = fingerprintmatches[fingerprints[source]]
+        if run and sourcefile != uniquefiles[fingerprints[source]]:
+            run = copy.deepcopy(run)
+            run['provenance'] = str(sourcefile)
+        matches[source] = (run, datatype, index)
+
+    return matches
+
+
+def _load_template(yamlfile: Path) -> dict:
+    """
+    Reads a (static) template bidsmap from the heuristics folder. The template is read from disk only once per process
+    (as json-data, see _read_template) and then parsed into a new dictionary for every call, i.e. callers can modify it
+
+    :param yamlfile:    The full pathname of the template bidsmap yaml-file
+    :return:            The parsed bidsmap data
+    """
+
+    try:
+        return bids.loads_json(_read_template(yamlfile, yamlfile.stat().st_mtime))
+    except (TypeError, ValueError) as cacheerror:
+        LOGGER.debug(f"Could not read the json-data of {yamlfile}\n{cacheerror}")
+        with yamlfile.open('r') as stream:
+            return yaml.load(stream)
+
+
+@lru_cache(maxsize=None)
+def _read_template(yamlfile: Path, mtime: float) -> bytes:
+    """
+    Reads the (json-serialized) data of a template bidsmap. The json-data is cached in memory (i.e. per process), such
+    that the (slow) yaml-parsing is done only once and the (fast) json-parsing yields a new dictionary for every call
+
+    :param yamlfile:    The full pathname of the template bidsmap yaml-file
+    :param mtime:       The modification time of the yaml-file, such that an edited template is read again
+    :return:            The json-serialized bidsmap data
+    """
+
+    with yamlfile.open('r') as stream:
+        return bids.dumps_json(yaml.load(stream))
+
+
+def _swap_ext(filepath: Path, ext: str) -> Path:
+    """Returns filepath with all its extensions (e.g. '.nii.gz') replaced by ext, without the intermediate Path objects of with_suffix('').with_suffix(ext)"""
+
+    return filepath.with_name(filepath.name.split('.', 1)[0] + ext)
+
+
+def _is_dynamic(value) -> bool:
+    """Checks whether a bidsmap value is a <<dynamic>> value (i.e. a value that is replaced during bidscoiner runtime)"""
+
+    return isinstance(value, str) and len(value) >= 4 and value[:2] == '<<' and value[-2:] == '>>'
+
+
+@lru_cache(maxsize=None)
+def _warn_nonstandard(entitykey: str):
+    """Warns (only once per entity key) that a bidsname entity is not part of the BIDS standard"""
+
+    LOGGER.warning(f"{entitykey} not in bids standard, but added as part of new file name, please confirm this is inentional")
+
+
 def get_bidsname_custom(subid: str, sesid: str, run: dict, runtime: bool=False) -> str:
     """
     Composes a filename as it should be according to the BIDS standard using the BIDS keys in run. The bids values are
@@ -1165,13 +1286,12 @@ def get_bidsname_custom(subid: str, sesid: str, run: dict, runtime: bool=False)
         sesid = f"ses-{cleanup_value(sesid)}"
 
     # Compose a bidsname from valid BIDS entities only
-    bidsname = f"{subid}{add_prefix('_', sesid)}"                               # Start with the subject/session identifier
-    # Get default entity keys
-    defaultkeys = [default_entities[entity]['entity'] for entity in default_entities]
-    for entitykey in [entities[entity]['entity'] for entity in entities]:
-        if entitykey not in defaultkeys:
-            LOGGER.warning(f"{entitykey} not in bids standard, but added as part of new file name, please confirm this is inentional")
-        bidsvalue = run['bids'].get(entitykey)                                  # Get the entity data from the run
+    bidsname   = f"{subid}{add_prefix('_', sesid)}"                             # Start with the subject/session identifier
+    entitykeys = sorted((key for key in run['bids'] if key in _ENTITY_ORDER and key not in ('sub','ses')), key=_ENTITY_ORDER.get)
+    for entitykey in entitykeys:                                                # Only the (few) entities that are in the run
+        if entitykey not in _DEFAULT_ENTITY_KEYS:
+            _warn_nonstandard(entitykey)
+        bidsvalue = run['bids'][entitykey]                                      # Get the entity data from the run
         if isinstance(bidsvalue, list):
             bidsvalue = bidsvalue[bidsvalue[-1]]                                # Get the selected item
         else:
@@ -1221,9 +1341,8 @@ def load_bidsmap_custom(yamlfile: Path, folder: Path=Path(), report: Union[bool,
     elif report:
         LOGGER.info(f"Reading: {yamlfile}")
 
-    # Read the heuristics from the bidsmap file
-    with yamlfile.open('r') as stream:
-        bidsmap = yaml.load(stream)
+    # Get a copy of the cached bidsmap, so that callers can safely modify it
+    bidsmap = copy.deepcopy(_load_bidsmap_cached(yamlfile, yamlfile.stat().st_mtime_ns))
 
     # Issue a warning if the version in the bidsmap YAML-file is not the same as the bidscoin version
     if 'bidscoin' in bidsmap['Options'] and 'version' in bidsmap['Options']['bidscoin']:
@@ -1235,6 +1354,32 @@ def load_bidsmap_custom(yamlfile: Path, folder: Path=Path(), report: Union[bool,
     if bidsmapversion != bidscoin.version() and report:
         LOGGER.warning(f'BIDScoiner version conflict: {yamlfile} was created using version {bidsmapversion}, but this is version {bidscoin.version()}')
 
+    # Validate the bidsmap entries
+    check_bidsmap(bidsmap, report)
+
+    return bidsmap, yamlfile
+
+
+@lru_cache(maxsize=8)
+def _load_bidsmap_cached(yamlfile: Path, mtime_ns: int) -> dict:
+    """
+    Reads and patches the bidsmap yaml-file (see load_bidsmap_custom). The result is cached, so that an unchanged
+    bidsmap is read only once (NB: the cached bidsmap should not be modified). The version check and the validation
+    are left to load_bidsmap_custom, so that they are reported on every load
+
+    :param yamlfile:    The full pathname of the bidsmap yaml-file
+    :param mtime_ns:    The modification time of the yaml-file, such that an edited bidsmap is read again
+    :return:            The bidsmap data
+    """
+
+    # Read the heuristics from the bidsmap file
+    if yamlfile.parent == heuristics_folder:
+        bidsmap = _load_template(yamlfile)
+    else:
+        with yamlfile.open('r') as stream:
+            bidsmap = yaml.load(stream)
+    bidsmap = _intern_keys(bidsmap)
+
     # Add missing provenance info, run dictionaries and bids entities
     run_ = get_run_()
     for dataformat in bidsmap:
@@ -1254,13 +1399,12 @@ def load_bidsmap_custom(yamlfile: Path, folder: Path=Path(), report: Union[bool,
                         run[key] = val
 
                 # Add missing bids entities
-                for typegroup in bidsdatatypes.get(datatype,[]):
-                    if run['bids']['suffix'] in typegroup['suffixes']:      # run_found = True
-                        for entityname in typegroup['entities']:
-                            entitykey = entities[entityname]['entity']
-                            if entitykey not in run['bids'] and entitykey not in ('sub','ses'):
-                                LOGGER.debug(f"Adding missing {dataformat}/{datatype} entity key: {entitykey}")
-                                run['bids'][entitykey] = ''
+                suffixitem = lookup_suffix(run['bids'].get('suffix'), datatype)
+                if suffixitem and not (suffixitem[2].issubset(run['bids']) and suffixitem[3].issubset(run['bids'])):
+                    for entitykey in suffixitem[4]:
+                        if entitykey not in run['bids']:
+                            LOGGER.debug(f"Adding missing {dataformat}/{datatype} entity key: {entitykey}")
+                            run['bids'][entitykey] = ''
 
     # Make sure we get a proper dictionary with plugins
     if not bidsmap['Options'].get('plugins'):
@@ -1269,10 +1413,7 @@ def load_bidsmap_custom(yamlfile: Path, folder: Path=Path(), report: Union[bool,
         if not bidsmap['Options']['plugins'].get(plugin):
             bidsmap['Options']['plugins'][plugin] = {}
 
-    # Validate the bidsmap entries
-    check_bidsmap(bidsmap, report)
-
-    return bidsmap, yamlfile
+    return bidsmap
 
 
 def test(options) -> bool:
@@ -1294,6 +1435,245 @@ def test(options) -> bool:
     return bidscoin.run_command(command)
 
 
+# The dcm2niix command-line (the path and args are taken from the plugin options)
+_DCM2NIIX_COMMAND = '{path}dcm2niix {args} -f "{filename}" -o "{outfolder}" "{source}"'
+
+
+def _prepare_run(source: Path, sourcefile: Path, run: dict, datatype: str, bidsfolder: Path, bidsses: Path, subid: str, sesid: str, manufacturer: str) -> Tuple[Path, str]:
+    """
+    Composes the BIDS output name of a run and creates its output folder. Physiological log files are converted right
+    away (dcm2niix can't handle these)
+
+    :param source:          The source folder or file of the run
+    :param sourcefile:      The (representative) source-file of the run
+    :param run:             The run mapping with the BIDS key-value pairs
+    :param datatype:        The BIDS datatype of the run
+    :param bidsfolder:      The full-path name of the BIDS root-folder
+    :param bidsses:         The full-path name of the BIDS session-folder
+    :param subid:           The subject identifier, i.e. name of the subject folder (e.g. 'sub-001')
+    :param sesid:           The optional session identifier, i.e. name of the session folder (e.g. 'ses-01')
+    :param manufacturer:    The manufacturer of the scanner (used for the derivatives folder)
+    :return:                The output folder and the BIDS name of the run
+    """
+
+    LOGGER.info(f"Processing: {source}")
+
+    # Create the BIDS session/datatype output folder
+    if run['bids']['suffix'] in _get_derivatives(datatype):
+        outfolder = bidsfolder/'derivatives'/manufacturer.replace(' ','')/subid/sesid/datatype
+    else:
+        outfolder = bidsses/datatype
+    outfolder.mkdir(parents=True, exist_ok=True)
+
+    # Modify echo time before run
+    bidsname  = get_bidsname_custom(subid, sesid, run, runtime=True)
+    echoindex = run['bids'].get('echo', '')
+    if _is_dynamic(echoindex):
+        currentechoindex = get_bidsvalue(bidsname, 'echo')
+        if currentechoindex.isdecimal():
+            outnames = {entry.name.split('.', 1)[0] for entry in os.scandir(outfolder)}     # The existing bidsnames (without extensions)
+            echonr   = int(currentechoindex)
+            while bidsname in outnames:                                                     # Take the first free echo index
+                echonr  += 1
+                bidsname = get_bidsvalue(bidsname, 'echo', str(echonr))
+
+    # Compose the BIDS filename using the matched run
+    runindex  = run['bids'].get('run', '')
+    if _is_dynamic(runindex):
+        bidsname = bids.increment_runindex(outfolder, bidsname)
+    bidsfile  = outfolder/bidsname
+    bidsjson  = bidsfile.with_suffix('.json')
+
+    # Check if file already exists (-> e.g. when a static runindex is used)
+    if bidsjson.is_file():
+        LOGGER.warning(f"{bidsfile}.* already exists and will be deleted -- check your results carefully!")
+        for ext in outputexts:
+            bidsfile.with_suffix(ext).unlink(missing_ok=True)
+
+    # Convert physiological log files (dcm2niix can't handle these)
+    if run['bids']['suffix'] == 'physio':
+        if _get_dicomfile(source, 2).name:
+            LOGGER.warning(f"Found > 1 DICOM file in {source}, using: {sourcefile}")
+        try:                        # NB: Only imported when needed (physio imports pandas, which is slow)
+            from bidscoin import physio
+        except ImportError:
+            import physio           # This should work if bidscoin was not pip-installed
+        physiodata = physio.readphysio(sourcefile)
+        physio.physio2tsv(physiodata, bidsfile)
+
+    return outfolder, bidsname
+
+
+def _postprocess_run(sourcefile: Path, run: dict, datatype: str, outfolder: Path, bidsname: str, converted: bool, crop: bool, bidsmap: dict, bidsses: Path) -> list:
+    """
+    Renames the dcm2niix output files of a run to proper BIDS names and adds the meta-data to its json sidecar files
+
+    :param sourcefile:  The (representative) source-file of the run
+    :param run:         The run mapping with the BIDS key-value pairs
+    :param datatype:    The BIDS datatype of the run
+    :param outfolder:   The output folder of the run
+    :param bidsname:    The BIDS name of the run
+    :param converted:   True if the run was converted by dcm2niix, False if it was converted by physio
+    :param crop:        True if dcm2niix was run with cropping ('-x y')
+    :param bidsmap:     The full mapping heuristics from the bidsmap YAML-file
+    :param bidsses:     The full-path name of the BIDS session-folder
+    :return:            The (filename, acq_time) rows for the scans.tsv file
+    """
+
+    bidsjson  = (outfolder/bidsname).with_suffix('.json')
+    jsonfiles = {bidsjson}                                          # Set -> Collect the associated json-files (for updating them later) -- possibly > 1
+    scanrows  = []
+    if converted:
+
+        # Take a snapshot of the dcm2niix output files (instead of globbing the output folder for every search), which is kept up-to-date when renaming files
+        outfiles = {entry.name for entry in os.scandir(outfolder) if entry.name.startswith(bidsname)}
+
+        # Replace uncropped output image with the cropped one
+        if crop:
+            for dcm2niixname in [outfile for outfile in outfiles if '_Crop_' in outfile[len(bidsname):]]:        # e.g. *_Crop_1.nii.gz. NB: The order is irrelevant (each file gets its own name)
+                stem        = dcm2niixname.split('.', 1)[0]
+                newbidsname = stem.rsplit('_Crop_', 1)[0] + dcm2niixname[len(stem):]
+                LOGGER.info(f"Found dcm2niix _Crop_ postfix, replacing original file\n{outfolder/dcm2niixname} ->\n{outfolder/newbidsname}")
+                os.replace(outfolder/dcm2niixname, outfolder/newbidsname)
+                outfiles.discard(dcm2niixname)
+                outfiles.add(newbidsname)
+
+        # Rename all files that got additional postfixes from dcm2niix. See: https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md
+        dcm2niixpostfixes = ('_c', '_i', '_Eq', '_real', '_imaginary', '_MoCo', '_t', '_Tilt', '_e', '_ph')
+        postfixpatterns   = [f"*{dcm2niixpostfix}*.nii*" for dcm2niixpostfix in dcm2niixpostfixes]
+        dcm2niixfiles     = sorted(outfolder/outfile for outfile in outfiles if any(fnmatch(outfile[len(bidsname):], pattern) for pattern in postfixpatterns))
+        if not bidsjson.is_file() and dcm2niixfiles:                                                        # Possibly renamed by dcm2niix, e.g. with multi-echo data (but not always for the first echo)
+            jsonfiles.discard(bidsjson)
+        for dcm2niixfile in dcm2niixfiles:
+            oldstem     = dcm2niixfile.name.split('.', 1)[0]
+            ext         = dcm2niixfile.name[len(oldstem):]                                                  # E.g. '.nii.gz'
+            postfixes   = oldstem[len(bidsname):].split('_')[1:]                                            # dcm2niix postfixes _c%d, _e%d and _ph (and any combination of these in that order) are for multi-coil data, multi-echo data and phase data
+            newbidsfile = outfolder/(bidsname + ext)                                                        # Strip all the additional postfixes in one go
+            LOGGER.info(f"Found dcm2niix {postfixes} postfixes, renaming\n{dcm2niixfile} ->\n{newbidsfile}")
+            if newbidsfile.is_file():
+                LOGGER.warning(f"Overwriting existing {newbidsfile} file -- check your results carefully!")
+            dcm2niixfile.replace(newbidsfile)
+            outfiles.discard(dcm2niixfile.name)
+            outfiles.add(newbidsfile.name)
+
+            # Rename all associated files (i.e. the json-, bval- and bvec-files)
+            oldjsonfile = _swap_ext(dcm2niixfile, '.json')
+            newjsonfile = _swap_ext(newbidsfile, '.json')
+            if not oldjsonfile.is_file():
+                LOGGER.warning(f"Unexpected file conversion result: {oldjsonfile} not found")
+            else:
+                jsonfiles.discard(oldjsonfile)
+                jsonfiles.add(newjsonfile)
+            for oldname in [outfile for outfile in outfiles if outfile.startswith(oldstem + '.')]:
+                newfile = _swap_ext(newbidsfile, oldname[len(oldstem):])
+                (outfolder/oldname).replace(newfile)
+                outfiles.discard(oldname)
+                outfiles.add(newfile.name)
+
+    # Loop over and adapt all the newly produced json files and write to the scans.tsv file (NB: assumes every nifti-file comes with a json-file)
+    for jsonfile in sorted(jsonfiles):
+
+        # Add a dummy b0 bval- and bvec-file for any file without a bval/bvec file (e.g. sbref, b0 scans)
+        if datatype == 'dwi':
+            bvecfile = jsonfile.with_suffix('.bvec')
+            bvalfile = jsonfile.with_suffix('.bval')
+            if not bvecfile.is_file():
+                LOGGER.info(f"Adding dummy bvec file: {bvecfile}")
+                bvecfile.write_text('0\n0\n0\n')
+            if not bvalfile.is_file():
+                LOGGER.info(f"Adding dummy bval file: {bvalfile}")
+                bvalfile.write_text('0\n')
+
+        # Load the json meta-data
+        jsondata = bids.load_json(jsonfile)
+
+        # Add the TaskName to the meta-data
+        if datatype == 'func' and 'TaskName' not in jsondata:
+            jsondata['TaskName'] = run['bids']['task']
+
+        # Add the TracerName and TaskName to the meta-data
+        elif datatype == 'pet' and 'TracerName' not in jsondata:
+            jsondata['TracerName'] = run['bids']['trc']
+
+        # Add all the meta data to the json-file except `IntendedFor`, which is handled separately later
+        for metakey, metaval in run['meta'].items():
+            if metakey != 'IntendedFor':
+                LOGGER.info(f"Adding '{metakey}: {metaval}' to: {jsonfile}")
+                metaval = bids.get_dynamicvalue(metaval, sourcefile, cleanup=False, runtime=True)
+            jsondata[metakey] = metaval
+        bids.save_json(jsondata, jsonfile)
+
+        # Parse the acquisition time from the json file or else from the source header (NB: assuming the source file represents the first acquisition)
+        outputfile = [jsonfile.with_suffix(ext) for ext in dataexts if jsonfile.with_suffix(ext).is_file()]         # Find the corresponding nifti/tsv.gz file (there should be only one)
+        if not outputfile:
+            LOGGER.exception(f"No data-file found with {jsonfile} when updating the scans.tsv file")
+        elif datatype not in bidsmap['Options']['bidscoin']['bidsignore'] and not run['bids']['suffix'] in _get_derivatives(datatype):
+            if 'AcquisitionTime' not in jsondata or not jsondata['AcquisitionTime']:
+                jsondata['AcquisitionTime'] = bids.get_sourcevalue('AcquisitionTime', sourcefile)       # DICOM
+            if not jsondata['AcquisitionTime']:
+                jsondata['AcquisitionTime'] = bids.get_sourcevalue('exam_date', sourcefile)             # PAR/XML
+            try:
+                acq_time = bids.parse_datetime(jsondata['AcquisitionTime'])
+                acq_time = '1925-01-01T' + acq_time.strftime('%H:%M:%S')                                # Privacy protection (see BIDS specification)
+            except Exception as jsonerror:
+                LOGGER.warning(f"Could not parse the acquisition time from: {sourcefile}\n{jsonerror}")
+                acq_time = 'n/a'
+            scanpath = outputfile[0].relative_to(bidsses)
+            scanrows.append((scanpath.as_posix(), acq_time))
+
+    return scanrows
+
+
+def _convert_runs(rungroups: list, bidsmap: dict, bidsfolder: Path, bidsses: Path, subid: str, sesid: str, manufacturer: str) -> list:
+    """
+    Converts the source-files of the run groups to nifti-files in the BIDS session-folder. The runs of a group are
+    converted in order, so that runs that get the same bidsname also get proper (increasing) run and echo indices. The
+    groups are independent, so in each round the next run of every group is converted, with the (slow) dcm2niix
+    conversions running concurrently. Everything else (naming, post-processing and logging) is done in this thread
+
+    :param rungroups:       The groups of runs that are converted, with the (source, sourcefile, run, datatype) tuples of the runs
+    :param bidsmap:         The full mapping heuristics from the bidsmap YAML-file
+    :param bidsfolder:      The full-path name of the BIDS root-folder
+    :param bidsses:         The full-path name of the BIDS session-folder
+    :param subid:           The subject identifier, i.e. name of the subject folder (e.g. 'sub-001')
+    :param sesid:           The optional session identifier, i.e. name of the session folder (e.g. 'ses-01')
+    :param manufacturer:    The manufacturer of the scanner (used for the derivatives folder)
+    :return:                The (filename, acq_time) rows for the scans.tsv file
+    """
+
+    # Get the plugin options once (instead of for every run)
+    options  = bidsmap['Options']['plugins']['custom_pancreas']
+    path     = options.get('path', '')
+    args     = options.get('args', '')
+    crop     = '-x y' in args
+
+    scanrows = []
+    for runs in zip_longest(*rungroups):
+        runs = [runitem for runitem in runs if runitem]             # The next run of every group that has runs left
+
+        # Name the runs and compose the dcm2niix commands
+        outputs  = [_prepare_run(*runitem, bidsfolder, bidsses, subid, sesid, manufacturer) for runitem in runs]
+        commands = {}
+        for (source, sourcefile, run, datatype), (outfolder, bidsname) in zip(runs, outputs):
+            if run['bids']['suffix'] != 'physio':
+                commands[source] = _DCM2NIIX_COMMAND.format(
+                    path      = path,
+                    args      = args,
+                    filename  = bidsname,
+                    outfolder = outfolder,
+                    source    = source)
+
+        # Convert the source-files in the run folders to nifti's in the BIDS-folder
+        success = dict(zip(commands, bidscoin.run_commands(list(commands.values()))))
+
+        # Rename and add meta-data to the output files
+        for (source, sourcefile, run, datatype), (outfolder, bidsname) in zip(runs, outputs):
+            if success.get(source, True):
+                scanrows.extend(_postprocess_run(sourcefile, run, datatype, outfolder, bidsname, source in commands, crop, bidsmap, bidsses))
+
+    return scanrows
+
+
 def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path, personals: dict, subprefix: str, sesprefix: str) -> None:
     """
     The bidscoiner plugin to convert the session DICOM and PAR/REC source-files into BIDS-valid nifti-files in the
@@ -1320,7 +1700,7 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path, personals:
     if dataformat == 'DICOM':
         sources = bidscoin.lsdirs(session)
         for source in sources:
-            sourcefile = bids.get_dicomfile(source)
+            sourcefile = _get_dicomfile(source)
             if sourcefile.name:
                 manufacturer = bids.get_dicomfield('Manufacturer', sourcefile)
                 break
@@ -1351,30 +1731,30 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path, personals:
         return
 
     # Create the BIDS session-folder and a scans.tsv file
-    bidsses = bidsfolder/subid/sesid
+    bidssub = bidsfolder/subid
+    bidsses = bidssub/sesid
     if bidsses.is_dir():
         LOGGER.warning(f"Existing BIDS output-directory found, which may result in duplicate data (with increased run-index). Make sure {bidsses} was cleaned-up from old data before (re)running the bidscoiner")
     bidsses.mkdir(parents=True, exist_ok=True)
     scans_tsv = bidsses/f"{subid}{bids.add_prefix('_',sesid)}_scans.tsv"
-    if scans_tsv.is_file():
-        scans_table = pd.read_csv(scans_tsv, sep='\t', index_col='filename')
-    else:
-        scans_table = pd.DataFrame(columns=['acq_time'], dtype='str')
-        scans_table.index.name = 'filename'
+    scans_rows = {}                                                     # The acq_time values per filename, which are added to the scans.tsv file in one go
 
     # Process all the source files or run subfolders
+    sourcefiles = {}
     for source in sources:
+        sourcefile = _get_dicomfile(source) if dataformat == 'DICOM' else source
+        if sourcefile.name:
+            sourcefiles[source] = sourcefile
 
-        # Get a source-file
-        if dataformat == 'DICOM':
-            sourcefile = bids.get_dicomfile(source)
-        elif dataformat == 'PAR':
-            sourcefile = source
-        if not sourcefile.name:
-            continue
+    # Get the matching runs from the bidsmap
+    matches = _match_sourcefiles(sourcefiles, bidsmap, dataformat)
+
+    # Collect the runs that are converted, grouped by the datatype and suffix (i.e. the runs that can get the same bidsname)
+    rungroups = {}
+    for source, sourcefile in sourcefiles.items():
+
+        run, datatype, index = matches[source]
 
-        # Get a matching run from the bidsmap
-        run, datatype, index = bids.get_matching_run(sourcefile, bidsmap, dataformat)
         # Check if we should ignore this run
         if datatype == bids.ignoredatatype:
             LOGGER.info(f"Leaving out: {source}")
@@ -1385,157 +1765,26 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path, personals:
             # LOGGER.error(f"Skipping unknown '{datatype}' run: {sourcefile}\n-> Re-run the bidsmapper and delete {bidsses} to solve this warning")
             continue
 
-        LOGGER.info(f"Processing: {source}")
+        rungroups.setdefault((datatype, run['bids']['suffix']), []).append((source, sourcefile, run, datatype))
 
-        # Create the BIDS session/datatype output folder
-        if run['bids']['suffix'] in bids.get_derivatives(datatype):
-            outfolder = bidsfolder/'derivatives'/manufacturer.replace(' ','')/subid/sesid/datatype
-        else:
-            outfolder = bidsses/datatype
-        outfolder.mkdir(parents=True, exist_ok=True)
-
-        # Modify echo time before run
-        bidsname  = get_bidsname_custom(subid, sesid, run, runtime=True)
-        echoindex = run['bids'].get('echo', '')
-        if echoindex.startswith('<<') and echoindex.endswith('>>'):
-            while list(outfolder.glob(bidsname + '.*')):
-                currentechoindex = bids.get_bidsvalue(bidsname, 'echo')
-                if runindex:
-                    bidsname = get_bidsvalue(bidsname, 'echo', str(int(currentechoindex) + 1))
-
-        # Compose the BIDS filename using the matched run
-        runindex  = run['bids'].get('run', '')
-        if runindex.startswith('<<') and runindex.endswith('>>'):
-            bidsname = bids.increment_runindex(outfolder, bidsname)
-        jsonfiles = [(outfolder/bidsname).with_suffix('.json')]      # List -> Collect the associated json-files (for updating them later) -- possibly > 1
-
-        # Check if file already exists (-> e.g. when a static runindex is used)
-        if (outfolder/bidsname).with_suffix('.json').is_file():
-            LOGGER.warning(f"{outfolder/bidsname}.* already exists and will be deleted -- check your results carefully!")
-            for ext in ('.nii.gz', '.nii', '.json', '.bval', '.bvec', '.tsv.gz'):
-                (outfolder/bidsname).with_suffix(ext).unlink(missing_ok=True)
-
-        # Convert physiological log files (dcm2niix can't handle these)
-        if run['bids']['suffix'] == 'physio':
-            if bids.get_dicomfile(source, 2).name:
-                LOGGER.warning(f"Found > 1 DICOM file in {source}, using: {sourcefile}")
-            physiodata = physio.readphysio(sourcefile)
-            physio.physio2tsv(physiodata, outfolder/bidsname)
-
-        # Convert the source-files in the run folder to nifti's in the BIDS-folder
-        else:
-            command = '{path}dcm2niix {args} -f "{filename}" -o "{outfolder}" "{source}"'.format(
-                path      = bidsmap['Options']['plugins']['custom_pancreas'].get('path',''),
-                args      = bidsmap['Options']['plugins']['custom_pancreas'].get('args',''),
-                filename  = bidsname,
-                outfolder = outfolder,
-                source    = source)
-            if not bidscoin.run_command(command):
-                continue
-
-            # Replace uncropped output image with the cropped one
-            if '-x y' in bidsmap['Options']['plugins']['custom_pancreas']['args']:
-                for dcm2niixfile in sorted(outfolder.glob(bidsname + '*_Crop_*')):                              # e.g. *_Crop_1.nii.gz
-                    ext         = ''.join(dcm2niixfile.suffixes)
-                    newbidsfile = str(dcm2niixfile).rsplit(ext,1)[0].rsplit('_Crop_',1)[0] + ext
-                    LOGGER.info(f"Found dcm2niix _Crop_ postfix, replacing original file\n{dcm2niixfile} ->\n{newbidsfile}")
-                    dcm2niixfile.replace(newbidsfile)
-
-            # Rename all files that got additional postfixes from dcm2niix. See: https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md
-            dcm2niixpostfixes = ('_c', '_i', '_Eq', '_real', '_imaginary', '_MoCo', '_t', '_Tilt', '_e', '_ph')
-            dcm2niixfiles     = sorted(set([dcm2niixfile for dcm2niixpostfix in dcm2niixpostfixes for dcm2niixfile in outfolder.glob(f"{bidsname}*{dcm2niixpostfix}*.nii*")]))
-            if not jsonfiles[0].is_file() and dcm2niixfiles:                                                    # Possibly renamed by dcm2niix, e.g. with multi-echo data (but not always for the first echo)
-                jsonfiles.pop(0)
-            for dcm2niixfile in dcm2niixfiles:
-                ext         = ''.join(dcm2niixfile.suffixes)
-                postfixes   = str(dcm2niixfile).split(bidsname)[1].rsplit(ext)[0].split('_')[1:]
-                newbidsname = dcm2niixfile.name                                                                 # Strip the additional postfixes and assign them to bids entities in the for-loop below
-                for postfix in postfixes:                                                                       # dcm2niix postfixes _c%d, _e%d and _ph (and any combination of these in that order) are for multi-coil data, multi-echo data and phase data
-                    newbidsname = newbidsname.replace(postfix, '').replace('__.', '.').replace('_.', '.')
-                    newbidsfile = outfolder/newbidsname
-                LOGGER.info(f"Found dcm2niix {postfixes} postfixes, renaming\n{dcm2niixfile} ->\n{newbidsfile}")
-                if newbidsfile.is_file():
-                    LOGGER.warning(f"Overwriting existing {newbidsfile} file -- check your results carefully!")
-                dcm2niixfile.replace(newbidsfile)
-
-                # Rename all associated files (i.e. the json-, bval- and bvec-files)
-                oldjsonfile = dcm2niixfile.with_suffix('').with_suffix('.json')
-                newjsonfile = newbidsfile.with_suffix('').with_suffix('.json')
-                if not oldjsonfile.is_file():
-                    LOGGER.warning(f"Unexpected file conversion result: {oldjsonfile} not found")
-                else:
-                    if oldjsonfile in jsonfiles:
-                        jsonfiles.remove(oldjsonfile)
-                    if newjsonfile not in jsonfiles:
-                        jsonfiles.append(newjsonfile)
-                for oldfile in outfolder.glob(dcm2niixfile.with_suffix('').stem + '.*'):
-                    oldfile.replace(newjsonfile.with_suffix(''.join(oldfile.suffixes)))
-
-        # Loop over and adapt all the newly produced json files and write to the scans.tsv file (NB: assumes every nifti-file comes with a json-file)
-        for jsonfile in sorted(set(jsonfiles)):
-
-            # Add a dummy b0 bval- and bvec-file for any file without a bval/bvec file (e.g. sbref, b0 scans)
-            if datatype == 'dwi':
-                bvecfile = jsonfile.with_suffix('.bvec')
-                bvalfile = jsonfile.with_suffix('.bval')
-                if not bvecfile.is_file():
-                    LOGGER.info(f"Adding dummy bvec file: {bvecfile}")
-                    bvecfile.write_text('0\n0\n0\n')
-                if not bvalfile.is_file():
-                    LOGGER.info(f"Adding dummy bval file: {bvalfile}")
-                    bvalfile.write_text('0\n')
-
-            # Load the json meta-data
-            with jsonfile.open('r') as json_fid:
-                jsondata = json.load(json_fid)
-
-            # Add the TaskName to the meta-data
-            if datatype == 'func' and 'TaskName' not in jsondata:
-                jsondata['TaskName'] = run['bids']['task']
-
-            # Add the TracerName and TaskName to the meta-data
-            elif datatype == 'pet' and 'TracerName' not in jsondata:
-                jsondata['TracerName'] = run['bids']['trc']
-
-            # Add all the meta data to the json-file except `IntendedFor`, which is handled separately later
-            for metakey, metaval in run['meta'].items():
-                if metakey != 'IntendedFor':
-                    LOGGER.info(f"Adding '{metakey}: {metaval}' to: {jsonfile}")
-                    metaval = bids.get_dynamicvalue(metaval, sourcefile, cleanup=False, runtime=True)
-                jsondata[metakey] = metaval
-            with jsonfile.open('w') as json_fid:
-                json.dump(jsondata, json_fid, indent=4)
-
-            # Parse the acquisition time from the json file or else from the source header (NB: assuming the source file represents the first acquisition)
-            outputfile = [file for file in jsonfile.parent.glob(jsonfile.stem + '.*') if file.suffix in ('.nii','.gz')]     # Find the corresponding nifti/tsv.gz file (there should be only one, let's not make assumptions about the .gz extension)
-            if not outputfile:
-                LOGGER.exception(f"No data-file found with {jsonfile} when updating {scans_tsv}")
-            elif datatype not in bidsmap['Options']['bidscoin']['bidsignore'] and not run['bids']['suffix'] in bids.get_derivatives(datatype):
-                if 'AcquisitionTime' not in jsondata or not jsondata['AcquisitionTime']:
-                    jsondata['AcquisitionTime'] = bids.get_sourcevalue('AcquisitionTime', sourcefile)       # DICOM
-                if not jsondata['AcquisitionTime']:
-                    jsondata['AcquisitionTime'] = bids.get_sourcevalue('exam_date', sourcefile)             # PAR/XML
-                try:
-                    acq_time = dateutil.parser.parse(jsondata['AcquisitionTime'])
-                    acq_time = '1925-01-01T' + acq_time.strftime('%H:%M:%S')                                # Privacy protection (see BIDS specification)
-                except Exception as jsonerror:
-                    LOGGER.warning(f"Could not parse the acquisition time from: {sourcefile}\n{jsonerror}")
-                    acq_time = 'n/a'
-                scanpath = outputfile[0].relative_to(bidsses)
-                scans_table.loc[scanpath.as_posix(), 'acq_time'] = acq_time
+    # Convert the run groups (the runs within a group are converted serially, to get proper run/echo-indices)
+    scans_rows.update(_convert_runs(list(rungroups.values()), bidsmap, bidsfolder, bidsses, subid, sesid, manufacturer))
 
     # Write the scans_table to disk
-    LOGGER.info(f"Writing acquisition time data to: {scans_tsv}")
-    scans_table.sort_values(by=['acq_time','filename'], inplace=True)
-    scans_table.to_csv(scans_tsv, sep='\t', encoding='utf-8')
+    bids.update_scans_tsv(scans_tsv, scans_rows)
 
     # Add IntendedFor search results and TE1+TE2 meta-data to the fieldmap json-files. This has been postponed until all datatypes have been processed (i.e. so that all target images are indeed on disk)
-    if (bidsses/'fmap').is_dir():
-        for jsonfile in sorted((bidsses/'fmap').glob('sub-*.json')):
+    fmapfolder = bidsses/'fmap'
+    if fmapfolder.is_dir():
 
-            # Load the existing meta-data
-            with jsonfile.open('r') as json_fid:
-                jsondata = json.load(json_fid)
+        # Walk the session folder only once for all IntendedFor searches, i.e. store the (name, path relative to the subject folder) of all imaging files
+        prefixlen   = len(str(bidssub)) + 1                                     # The length of the subject folder part of the (full) paths
+        sessionniis = sorted(((entry.name, entry.path[prefixlen:].replace(os.sep, '/')) for entry in bids.scandir_recursive(bidsses) if '.nii' in entry.name), key=lambda nii: nii[1].split('/'))
+
+        with os.scandir(fmapfolder) as entries:
+            fmapjsons = [fmapfolder/name for name in sorted(entry.name for entry in entries if entry.name.startswith('sub-') and entry.name.endswith('.json'))]
+        fmapdata = {jsonfile: bids.load_json(jsonfile) for jsonfile in fmapjsons}       # Load all the existing meta-data first, i.e. such that the magnitude data can be taken from memory
+        for jsonfile, jsondata in fmapdata.items():
 
             # Search for the imaging files that match the IntendedFor search criteria
             niifiles    = []
@@ -1546,13 +1795,14 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path, personals:
                     intendedfor = intendedfor[2:-2].split('><')
                 elif not isinstance(intendedfor, list):
                     intendedfor = [intendedfor]
-                for selector in intendedfor:
-                    niifiles.extend([Path(niifile).relative_to(bidsfolder/subid) for niifile in sorted(bidsses.rglob(f"*{selector}*.nii*")) if selector])
+                for selector in dict.fromkeys(selector for selector in intendedfor if selector):            # Search only once for every (non-empty) selector
+                    pattern = f"*{selector}*.nii*"
+                    niifiles.extend([niifile for niiname, niifile in sessionniis if fnmatch(niiname, pattern)])
 
                 # Add the IntendedFor data
                 if niifiles:
                     LOGGER.info(f"Adding IntendedFor to: {jsonfile}")
-                    jsondata['IntendedFor'] = [niifile.as_posix() for niifile in niifiles]  # The path needs to use forward slashes instead of backward slashes
+                    jsondata['IntendedFor'] = niifiles                                      # NB: The paths use forward slashes instead of backward slashes
                 else:
                     LOGGER.warning(f"Empty 'IntendedFor' fieldmap value in {jsonfile}: the search for {intendedfor} gave no results")
                     jsondata['IntendedFor'] = ''
@@ -1561,16 +1811,14 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path, personals:
 
             # Extract the echo times from magnitude1 and magnitude2 and add them to the phasediff json-file
             if jsonfile.name.endswith('phasediff.json'):
-                json_magnitude = [None, None]
+                stem           = jsonfile.name[:-len('phasediff.json')]                    # E.g. 'sub-01_ses-01_acq-foo_run-1_'
+                json_magnitude = [fmapfolder/f"{stem}magnitude{n+1}.json" for n in (0,1)]
                 echotime       = [None, None]
                 for n in (0,1):
-                    json_magnitude[n] = jsonfile.parent/jsonfile.name.replace('_phasediff', f"_magnitude{n+1}")
-                    if not json_magnitude[n].is_file():
+                    if json_magnitude[n] not in fmapdata:
                         LOGGER.error(f"Could not find expected magnitude{n+1} image associated with: {jsonfile}")
                     else:
-                        with json_magnitude[n].open('r') as json_fid:
-                            data = json.load(json_fid)
-                        echotime[n] = data['EchoTime']
+                        echotime[n] = fmapdata[json_magnitude[n]].get('EchoTime')
                 jsondata['EchoTime1'] = jsondata['EchoTime2'] = None
                 if None in echotime:
                     LOGGER.error(f"Cannot find and add valid EchoTime1={echotime[0]} and EchoTime2={echotime[1]} data to: {jsonfile}")
@@ -1581,9 +1829,11 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path, personals:
                     jsondata['EchoTime2'] = echotime[1]
                     LOGGER.info(f"Adding EchoTime1: {echotime[0]} and EchoTime2: {echotime[1]} to {jsonfile}")
 
-            # Save the collected meta-data to disk
-            with jsonfile.open('w') as json_fid:
-                json.dump(jsondata, json_fid, indent=4)
+        # Save the collected meta-data to disk
+        for jsonfile, jsondata in fmapdata.items():
+            bids.save_json(jsondata, jsonfile)
+
+    LOGGER.debug(f"Cached dicom-file lookups: {_get_dicomfile.cache_info()}, cached DICOM header reads: {bids.get_dicomfield.cache_info()}")
 
     # Collect personal data from a source header (PAR/XML does not contain personal info)
     if dataformat=='DICOM' and sourcefile.name:
@@ -1593,17 +1843,13 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path, personals:
                 personals['session_id'] = sesid
             else:
                 return                                              # Only take data from the first session -> BIDS specification
-        age = bids.get_dicomfield('PatientAge', sourcefile)         # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
-        if age.endswith('D'):
-            personals['age'] = str(int(float(age.rstrip('D'))/365.2524))
-        elif age.endswith('W'):
-            personals['age'] = str(int(float(age.rstrip('W'))/52.1775))
-        elif age.endswith('M'):
-            personals['age'] = str(int(float(age.rstrip('M'))/12))
-        elif age.endswith('Y'):
-            personals['age'] = str(int(float(age.rstrip('Y'))))
+        dicomfields = bids.get_personalfields(sourcefile)
+        age = dicomfields['PatientAge']                             # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
+        ageunit = ageunits.get(age[-1:])
+        if ageunit:
+            personals['age'] = str(int(float(age[:-1])/ageunit))
         elif age:
             personals['age'] = age
-        personals['sex']     = bids.get_dicomfield('PatientSex',    sourcefile)
-        personals['size']    = bids.get_dicomfield('PatientSize',   sourcefile)
-        personals['weight']  = bids.get_dicomfield('PatientWeight', sourcefile)
+        personals['sex']     = dicomfields['PatientSex']
+        personals['size']    = dicomfields['PatientSize']
+        personals['weight']  = dicomfields['PatientWeight']
@@ -13,9 +13,8 @@
 ## Bug fix 2019-05-21: MB-SENSE with default ordering and odd number of slices per package
 ## ************************************************************************
 import numpy as np
-import numpy.matlib
-import snoop
 import logging
+from functools import lru_cache
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -24,28 +23,65 @@ logging.basicConfig(
 )
 #clear('all')
 ## 1 7 13 19 25 31 37 2 8 14 20 26 32 38 3 28 34 40 5 11 17 23 29 35 41 6 12 18 24 30 36 42
-MB_SENSE_factor = None
-Slices_per_band = None
-Slice_order = None
+## ************************************************************************
+## The (0-based) slice order of one band of nslices for the different slice scan orders
+def _fh_order(nslices, mb_sense):
+    return np.arange(nslices)
+
+def _hf_order(nslices, mb_sense):
+    return np.arange(nslices - 1, -1, -1)
+
+def _rev_central_order(nslices, mb_sense):
+    order = np.empty(nslices, dtype=int)
+    order[0::2] = np.arange(0, (nslices - 1) // 2 + 1)                  # up
+    order[1::2] = np.arange(nslices - 1, (nslices + 1) // 2 - 1, -1)    # down
+    return order
+
+def _interleaved_order(nslices, mb_sense):
+    step = int(np.round(np.sqrt(nslices)))
+    return np.concatenate([np.arange(start, nslices, step) for start in range(step)])
+
+def _default_order(nslices, mb_sense):
+    # The are a few special cases to consider here for MB-SENSE
+    if mb_sense and nslices == 8:
+        return _interleaved_order(nslices, mb_sense)
+    if mb_sense and (nslices <= 6 or np.mod(nslices, 2) == 0):
+        raise NotImplementedError(f"The MB-SENSE default (low/high alternating) slice order of {nslices} slices per band is not ported from the MATLAB code")
+    return np.concatenate([np.arange(0, nslices, 2), np.arange(1, nslices, 2)])
+
+Slice_order_handlers = {'FH': _fh_order, 'HF': _hf_order, 'rev. central': _rev_central_order, 'interleaved': _interleaved_order, 'default': _default_order}
+
+
+## The slice order only depends on the protocol parameters, so it is cached. NB: The returned array is read-only (copy it if needed)
+@lru_cache(maxsize=128)
+def get_sliceorder(Slices, MB_SENSE, MB_SENSE_factor, Slice_scan_order):
+
+    #We first perform a sanity check
+    if (np.mod(Slices,MB_SENSE_factor) != 0 and MB_SENSE == 'yes'):
+        raise Exception('These parameters are impossible')
+
+    # Get the (0-based) slice order of one band and stack it for all bands
+    handler = Slice_order_handlers.get(Slice_scan_order)
+    if handler is None:
+        Slice_order = np.array([])
+    elif MB_SENSE == 'yes':
+        band_order  = handler(Slices // MB_SENSE_factor, True)
+        Slice_order = band_order[None,:] + np.arange(MB_SENSE_factor)[:,None] * (Slices // MB_SENSE_factor)
+    else:
+        Slice_order = handler(Slices, False)
+    Slice_order.setflags(write=False)
+
+    return Slice_order
+
 
 # @snoop
 def test():
-    global Slices_per_band, MB_SENSE_factor, Slice_order
 
     Slices = 69
-    steps = np.round(np.sqrt(Slices))
-    slice = 1
-    sliceind = 1
-    startind = 1
+    steps = int(np.round(np.sqrt(Slices)))
     sliceorder = np.zeros(Slices)
-    while sliceind < Slices:
-
-        sliceorder[sliceind] = slice
-        sliceind = sliceind + 1
-        slice = slice + steps
-        if slice > Slices:
-            startind = startind + 1
-            slice = startind
+    # Interleave the slices with starting indices 1,2,...,steps (the first element is left 0)
+    sliceorder[1:] = np.concatenate([np.arange(start, Slices+1, steps) for start in range(1, steps+1)])[:Slices-1]
 
 
     ## ************************************************************************
@@ -57,122 +93,11 @@ def test():
     TR = 1.5
     ## ************************************************************************
 
-    #We first perform a sanity check
-    if (np.mod(Slices,MB_SENSE_factor) != 0 and str(MB_SENSE) == str('yes')):
-        raise Exception('These parameters are impossible')
+    Slice_order = get_sliceorder(Slices, MB_SENSE, MB_SENSE_factor, Slice_scan_order)
+    for idx, array_ in enumerate(Slice_order):
+        logging.info(f"row {idx}: {array_}")
 
-    Slice_order = []
-    #FH
-    if (str(Slice_scan_order) == str('FH')):
-        if (str(MB_SENSE) == str('yes')):
-            Slices_per_band = Slices / MB_SENSE_factor
-            for k in np.arange(1,MB_SENSE_factor+1).reshape(-1):
-                Slice_order[k:] = np.array([np.arange(Slices_per_band * (k - 1),Slices_per_band * (k - 1) + (Slices_per_band) - 1+1,1)])
-        else:
-            Slice_order = np.array([np.arange(0,Slices - 1+1,1)])
-        #HF
-    else:
-        if (str(Slice_scan_order) == str('HF')):
-            if (str(MB_SENSE) == str('yes')):
-                Slices_per_band = Slices / MB_SENSE_factor
-                for k in np.arange(1,MB_SENSE_factor+1).reshape(-1):
-                    Slice_order[k:] = np.array([np.arange(Slices_per_band * (k - 1) + (Slices_per_band) - 1,Slices_per_band * (k - 1)+- 1,- 1)])
-            else:
-                Slice_order = np.array([np.arange(Slices - 1,0+- 1,- 1)])
-            #rev. central
-        else:
-            if (str(Slice_scan_order) == str('rev. central')):
-                if (str(MB_SENSE) == str('yes')):
-                    Slices_per_band = Slices / MB_SENSE_factor
-                    for k in np.arange(1,MB_SENSE_factor+1).reshape(-1):
-                        up = np.array([np.arange(Slices_per_band * (k - 1),Slices_per_band * (k - 1) + int(np.floor((Slices_per_band - 1) / 2))+1,1)])
-                        down = np.array([np.arange(Slices_per_band * (k - 1) + Slices_per_band - 1,Slices_per_band * (k - 1) + np.ceil((Slices_per_band) / 2)+- 1,- 1)])
-                        Slice_order[k,np.arange[1,Slices_per_band+2,2]] = up
-                        Slice_order[k,np.arange[2,Slices_per_band+2,2]] = down
-                else:
-                    up = np.array([np.arange(0,int(np.floor((Slices - 1) / 2))+1,1)])
-                    down = np.array([np.arange(Slices - 1,np.ceil((Slices) / 2)+- 1,- 1)])
-                    Slice_order[np.arange[1,Slices+2,2]] = up
-                    Slice_order[np.arange[2,Slices+2,2]] = down
-                #interleaved
-            else:
-                if (str(Slice_scan_order) == str('interleaved')):
-                    if (str(MB_SENSE) == str('yes')):
-                        Slices_per_band = Slices / MB_SENSE_factor
-                        SliceGroup = 1
-                        temp_order = 1
-                        step = np.round(np.sqrt(double(Slices_per_band)))
-                        for k in np.arange(2,Slices_per_band+1).reshape(-1):
-                            current = temp_order(k - 1) + step
-                            if (current > Slices_per_band):
-                                SliceGroup = SliceGroup + 1
-                                current = SliceGroup
-                            temp_order = np.array([temp_order,current])
-                        for k in np.arange(1,MB_SENSE_factor+1).reshape(-1):
-                            Slice_order[k,:] = (temp_order - 1) + (k - 1) * Slices_per_band
-                    else:
-                        SliceGroup = 1
-                        Slice_order = 1
-                        step = np.round(np.sqrt(double(Slices)))
-                        for k in np.arange(2,Slices+1).reshape(-1):
-                            current = Slice_order(k - 1) + step
-                            if (current > Slices):
-                                SliceGroup = SliceGroup + 1
-                                current = SliceGroup
-                            Slice_order = np.array([Slice_order,current])
-                        Slice_order = Slice_order - 1
-                    #default
-                else:
-                    if (str(Slice_scan_order) == str('default')):
-                        if (str(MB_SENSE) == str('yes')):
-                            Slices_per_band = Slices / MB_SENSE_factor
-                            # The are a few special cases to consider here
-                            if (Slices_per_band <= 6):
-                                step = 2
-                                temp_order = np.zeros((1,Slices_per_band))
-                                half_locs_per_package = (Slices_per_band + 1) / step
-                                low_part_start_loc = 0
-                                low_part_act_loc = low_part_start_loc
-                                high_part_start_loc = Slices_per_band - 1
-                                high_part_act_loc = high_part_start_loc
-                                order = 1
-                                temp_order = temp_order + 1
-                            else:
-                                if (Slices_per_band == 8):
-                                    factor = 1
-                                    SliceGroup = 1
-                                    temp_order = 1
-                                    step = np.round(np.sqrt(double(Slices_per_band)))
-                                    for k in np.arange(2,Slices_per_band+1).reshape(-1):
-                                        current = temp_order(k - 1) + step
-                                        if (current > Slices_per_band):
-                                            SliceGroup = SliceGroup + 1
-                                            current = SliceGroup
-                                        temp_order = np.array([temp_order,current])
-                                else:
-                                    if (np.mod(Slices_per_band,2) == 0):
-                                        step = 2
-                                        temp_order = np.zeros((1,Slices_per_band))
-                                        half_locs_per_package = (Slices_per_band + 1) / step
-                                        low_part_start_loc = 0
-                                        low_part_act_loc = low_part_start_loc
-                                        high_part_start_loc = Slices_per_band - 1
-                                        high_part_act_loc = high_part_start_loc
-                                        order = 1
-                                        temp_order = temp_order + 1
-                                    else:
-                                        part1 = np.array([np.arange(0,(Slices_per_band - 1)+2,2)])
-                                        part2 = np.array([np.arange(1,(Slices_per_band - 1)+2,2)])
-                                        temp_order = cat(2,part1,part2)
-                                        temp_order = temp_order + 1
-                            for k in np.arange(1,MB_SENSE_factor+1).reshape(-1):
-                                Slice_order[k,:] = (temp_order - 1) + (k - 1) * Slices_per_band
-                        else:
-                            part1 = np.array([np.arange(0,(Slices - 1)+2,2)])
-                            part2 = np.array([np.arange(1,(Slices - 1)+2,2)])
-                            Slice_order = cat(2,part1,part2)
-
-    slice_timings = slicetime()
+    slice_timings = slicetime(TR, Slices, MB_SENSE_factor=MB_SENSE_factor if MB_SENSE == 'yes' else 1)
     for slice_timing in slice_timings:
         for element in slice_timings:
             for k in element:
@@ -182,7 +107,9 @@ def test():
     logging.info(slice_timings)
 
 # @snoop
-def slicetime(TRsec=1.5, Slices=69, isAscending=True, isSequential=False, DelayBetweenVolumesSec=0):
+## The slice timing only depends on the protocol parameters, so it is cached. NB: The returned array is read-only (copy it if needed)
+@lru_cache(maxsize=128)
+def slicetime(TRsec=1.5, Slices=69, isAscending=True, isSequential=False, DelayBetweenVolumesSec=0, MB_SENSE_factor=1):
 
     #compute slice timing
     # TRsec : sampling rate (TR) in seconds
@@ -190,6 +117,7 @@ def slicetime(TRsec=1.5, Slices=69, isAscending=True, isSequential=False, DelayB
     # isAscending: ascending (true) or descending (false) order
     # isSequential: interleaved (false) or sequential (true) order
     # DelayBetweenVolumesSec: pause between final slice of volume and start of next
+    # MB_SENSE_factor: the multiband (MB-SENSE) factor, i.e. the number of simultaneously acquired slices
     #Examples
     # sliceTime(2.0, 10, true, true); #ascending, sequential
     # sliceTime(2.0, 10, false, true); #descending, sequential
@@ -198,9 +126,8 @@ def slicetime(TRsec=1.5, Slices=69, isAscending=True, isSequential=False, DelayB
     # sliceTime(3.0, 10, true, true, 1.0); #ascending, sequential, sparse
 
 
-    TA = (TRsec - DelayBetweenVolumesSec) / Slices
-
-    bidsSliceTiming = np.array([np.arange(0,TRsec - TA+TA,TA)])
+    # Evenly spaced acquisition times (TA apart) of the slices. NB: linspace has no float-step round-off like arange
+    bidsSliceTiming = np.array([np.linspace(0,TRsec - DelayBetweenVolumesSec,Slices,endpoint=False)])
 
     if not isAscending :
         bidsSliceTiming = flip(bidsSliceTiming)
@@ -221,9 +148,7 @@ def slicetime(TRsec=1.5, Slices=69, isAscending=True, isSequential=False, DelayB
     #     else:
     #         logging.info('	],\n' % ())
 
-    TA = (TRsec - DelayBetweenVolumesSec) / (Slices / MB_SENSE_factor)
-
-    bidsSliceTiming = np.array([np.arange(0,TRsec - TA+TA,TA)])
+    bidsSliceTiming = np.array([np.linspace(0,TRsec - DelayBetweenVolumesSec,Slices // MB_SENSE_factor,endpoint=False)])
 
     if not isAscending :
         bidsSliceTiming = flip(bidsSliceTiming)
@@ -234,16 +159,9 @@ def slicetime(TRsec=1.5, Slices=69, isAscending=True, isSequential=False, DelayB
 
         if not np.mod(Slices,2) == 0 :
             logging.info('Timings for Philips or GE. Siemens volume with even number of slices differs https://www.mccauslandcenter.sc.edu/crnl/tools/stc)\n' % ())
-        
-        else:
-            order = np.array([np.arange(1,Slices_per_band+1,1)])
-            #order = Slice_order;#MM
-            bidsSliceTiming[order] = bidsSliceTiming
-
-    bidsSliceTiming = np.matlib.repmat(bidsSliceTiming,1,MB_SENSE_factor)
-    for idx, array_ in enumerate(Slice_order):
-        logging.info(f"row {idx}: {array_}")
 
+    bidsSliceTiming = np.tile(bidsSliceTiming,(1,MB_SENSE_factor))
+    bidsSliceTiming.setflags(write=False)
 
     logging.info(bidsSliceTiming.shape)
 
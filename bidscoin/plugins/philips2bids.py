@@ -15,20 +15,66 @@ NOTE
 """
 
 import logging
-import dateutil.parser
-import pandas as pd
-import json
-from typing import Union
+import os
+import csv
+from fnmatch import fnmatch
+from itertools import zip_longest
+from typing import Union, Tuple
 from pathlib import Path
 import shutil
-import re
 try:
     from bidscoin import bidscoin, bids, physio
+    from bidscoin.plugins import postfixPHILIPS
 except ImportError:
     import bidscoin, bids, physio     # This should work if bidscoin was not pip-installed
-
+    from plugins import postfixPHILIPS
 LOGGER = logging.getLogger(__name__)
 
+# The dcm2niix fieldmap postfixes that are renamed in order, i.e. (old, new, number of dcm2niix-files for which the renaming applies (None = all))
+_FMAP_RENAMES = (
+    ('_magnitude1a',    '_magnitude2', None),                                               # First catch this potential weird / rare case
+    ('_magnitude1_pha', '_phase2',     None),                                               # First catch this potential weird / rare case
+    ('_magnitude1_e1',  '_magnitude1', None),                                               # Case 2 = Two phase and magnitude images
+    ('_magnitude1_e2',  '_magnitude2', None),                                               # Case 2: This can happen when the e2 image is stored in the same directory as the e1 image, but with the e2 listed first
+    ('_magnitude2_e1',  '_magnitude1', None),                                               # Case 2: This can happen when the e2 image is stored in the same directory as the e1 image, but with the e2 listed first
+    ('_magnitude2_e2',  '_magnitude2', None),                                               # Case 2
+    ('_magnitude1_ph',  '_phasediff',  (2,3)),                                              # Case 1 = One or two magnitude + one phasediff image
+    ('_magnitude2_ph',  '_phasediff',  (2,3)),                                              # Case 1 = One or two magnitude + one phasediff image
+    ('_phasediff_e1',   '_phasediff',  None),                                               # Case 1
+    ('_phasediff_e2',   '_phasediff',  None),                                               # Case 1
+    ('_phasediff_ph',   '_phasediff',  None),                                               # Case 1
+    ('_magnitude1_ph',  '_phase1',     None),                                               # Case 2: One or two magnitude and phase images in one folder / datasource
+    ('_magnitude2_ph',  '_phase2',     None),                                               # Case 2: Two magnitude + two phase images in one folder / datasource
+    ('_phase1_e1',      '_phase1',     None),                                               # Case 2
+    ('_phase1_e2',      '_phase2',     None),                                               # Case 2: This can happen when the e2 image is stored in the same directory as the e1 image, but with the e2 listed first
+    ('_phase2_e1',      '_phase1',     None),                                               # Case 2: This can happen when the e2 image is stored in the same directory as the e1 image, but with the e2 listed first
+    ('_phase2_e2',      '_phase2',     None),                                               # Case 2
+    ('_phase1_ph',      '_phase1',     None),                                               # Case 2: One or two magnitude and phase images in one folder / datasource
+    ('_phase2_ph',      '_phase2',     None),                                               # Case 2: Two magnitude + two phase images in one folder / datasource
+    ('_magnitude_e1',   '_magnitude',  None),                                               # Case 3 = One magnitude + one fieldmap image
+    ('_fieldmap_e1',    '_magnitude',  (2,)),                                               # Case 3: One magnitude + one fieldmap image in one folder / datasource
+    ('_fieldmap_e1',    '_fieldmap',   None),                                               # Case 3
+    ('_magnitude_ph',   '_fieldmap',   None),                                               # Case 3: One magnitude + one fieldmap image in one folder / datasource
+    ('_fieldmap_ph',    '_fieldmap',   None),                                               # Case 3
+)
+_AGEUNITS = {'D': 365.2524, 'W': 52.1775, 'M': 12, 'Y': 1}                                   # The number of DICOM PatientAge units (days, weeks, months, years) per year
+
+
+def _jdump_all(jsondatas: dict):
+    """
+    Writes the data of many json (sidecar) files to disk in a pool of threads (i.e. to overlap the disk I/O latencies,
+    which is most useful for network storage)
+
+    :param jsondatas:   The {jsonfile: jsondata} dictionary with the data that is written to disk
+    :return:
+    """
+
+    from concurrent.futures import ThreadPoolExecutor         # NB: Only imported when needed
+
+    with ThreadPoolExecutor() as executor:
+        for _ in executor.map(bids.save_json, jsondatas.values(), jsondatas.keys()):   # NB: Iterate the results to raise any exceptions
+            pass
+
 
 def test(options) -> bool:
     """
@@ -83,6 +129,28 @@ def get_attribute(dataformat: str, sourcefile: Path, attribute: str, options: di
         return bids.get_parfield(attribute, sourcefile)
 
 
+def _get_matchkeys(bidsmaps: tuple, dataformat: str) -> Tuple[tuple, tuple]:
+    """
+    Gets the names of all the filesystem properties and attributes that are used to match the source-files with the runs
+    in the bidsmaps. Source-files with the same values for these keys match with the same run and yield the same run-item
+
+    :param bidsmaps:    The bidsmaps (e.g. the old study bidsmap and the template) with which the source-files are matched
+    :param dataformat:  The dataformat of the session, e.g. 'DICOM' or 'PAR'
+    :return:            The (sorted) property names and the (sorted) attribute names
+    """
+
+    propkeys = set()
+    attrkeys = set()
+    for bidsmap in bidsmaps:
+        for runs in (bidsmap.get(dataformat) or {}).values():
+            if not isinstance(runs, list): continue
+            for run in runs:
+                propkeys.update(propkey for propkey, propvalue in (run.get('properties') or {}).items() if propvalue)
+                attrkeys.update(run.get('attributes') or {})
+
+    return tuple(sorted(propkeys)), tuple(sorted(attrkeys))
+
+
 def bidsmapper_plugin(session: Path, bidsmap_new: dict, bidsmap_old: dict, template: dict, store: dict) -> None:
     """
     All the logic to map the Philips PAR/XML fields onto bids labels go into this function
@@ -114,6 +182,10 @@ def bidsmapper_plugin(session: Path, bidsmap_new: dict, bidsmap_old: dict, templ
     else:
         LOGGER.exception(f"Unsupported dataformat '{dataformat}'")
 
+    # Source-files with the same property and attribute values (fingerprints) yield the same run-item, so only one source-file per fingerprint needs to be matched
+    propkeys, attrkeys = _get_matchkeys((bidsmap_old, template), dataformat)
+    fingerprints       = set()
+
     # Update the bidsmap with the info from the source files
     for sourcefile in sourcefiles:
 
@@ -122,7 +194,11 @@ def bidsmapper_plugin(session: Path, bidsmap_new: dict, bidsmap_old: dict, templ
             LOGGER.error(f"No {dataformat} source information found in the bidsmap and template")
             return
 
-        datasource = bids.DataSource(sourcefile, plugin, dataformat)
+        datasource  = bids.DataSource(sourcefile, plugin, dataformat)
+        fingerprint = tuple(datasource.properties(key) for key in propkeys) + tuple(datasource.attributes(key) for key in attrkeys)
+        if fingerprint in fingerprints:
+            continue
+        fingerprints.add(fingerprint)
 
         # See if we can find a matching run in the old bidsmap
         run, index = bids.get_matching_run(datasource, bidsmap_old)
@@ -148,6 +224,342 @@ def bidsmapper_plugin(session: Path, bidsmap_new: dict, bidsmap_old: dict, templ
             bids.append_run(bidsmap_new, run)
 
 
+def _prepare_run(source: Path, sourcefile: Path, run: dict, outfolder: Path, subid: str, sesid: str) -> str:
+    """
+    Composes the BIDS output name of a run and creates its output folder. Physiological log files are converted right
+    away (dcm2niix can't handle these)
+
+    :param source:      The source folder or file of the run
+    :param sourcefile:  The (representative) source-file of the run
+    :param run:         The run mapping with the BIDS key-value pairs
+    :param outfolder:   The output folder of the run
+    :param subid:       The subject identifier, i.e. name of the subject folder (e.g. 'sub-001')
+    :param sesid:       The optional session identifier, i.e. name of the session folder (e.g. 'ses-01')
+    :return:            The BIDS name of the run
+    """
+
+    LOGGER.info(f"Processing: {source}")
+    outfolder.mkdir(parents=True, exist_ok=True)
+
+    # Compose the BIDS filename using the matched run
+    bidsname  = bids.get_bidsname(subid, sesid, run, runtime=True)
+    runindex  = run['bids'].get('run', '')
+    if runindex.startswith('<<') and runindex.endswith('>>'):
+        bidsname = bids.increment_runindex(outfolder, bidsname)
+    bidsjson  = (outfolder/bidsname).with_suffix('.json')
+
+    # Check if file already exists (-> e.g. when a static runindex is used)
+    if bidsjson.is_file():
+        LOGGER.warning(f"{outfolder/bidsname}.* already exists and will be deleted -- check your results carefully!")
+        for ext in ('.nii.gz', '.nii', '.json', '.bval', '.bvec', '.tsv.gz'):
+            (outfolder/bidsname).with_suffix(ext).unlink(missing_ok=True)
+
+    # Convert physiological log files (dcm2niix can't handle these)
+    if run['bids']['suffix'] == 'physio':
+        if bids.get_dicomfile(source, 2).name:                  # TODO: issue warning or support PAR
+            LOGGER.warning(f"Found > 1 DICOM file in {source}, using: {sourcefile}")
+        physiodata = physio.readphysio(sourcefile)
+        physio.physio2tsv(physiodata, outfolder/bidsname)
+
+    return bidsname
+
+
+def _postprocess_run(sourcefile: Path, run: dict, datatype: str, outfolder: Path, bidsname: str, converted: bool, crop: bool, isderivative: bool, bidsmap: dict, bidsses: Path) -> Tuple[list, dict]:
+    """
+    Renames the dcm2niix output files of a run to proper BIDS names and adds the meta-data to its json sidecar files
+
+    :param sourcefile:      The (representative) source-file of the run
+    :param run:             The run mapping with the BIDS key-value pairs
+    :param datatype:        The BIDS datatype of the run
+    :param outfolder:       The output folder of the run
+    :param bidsname:        The BIDS name of the run
+    :param converted:       True if the run was converted by dcm2niix, False if it was converted by physio
+    :param crop:            True if dcm2niix was run with cropping ('-x y')
+    :param isderivative:    True if the run is stored in the derivatives folder
+    :param bidsmap:         The full mapping heuristics from the bidsmap YAML-file
+    :param bidsses:         The full-path name of the BIDS session-folder
+    :return:                The (filename, acq_time) rows for the scans.tsv file and the written fmap and func json meta-data (for post-processing them without reading them back from disk)
+    """
+
+    datasource   = run['datasource']
+    runindex     = run['bids'].get('run', '')
+    fmapsuffixes = set(bids.bidsdatatypes['fmap'][0]['suffixes'])      # i.e. {'magnitude','magnitude1','magnitude2','phase1','phase2','phasediff','fieldmap'}. TODO: Make this robust for future BIDS versions
+    bidsjson     = (outfolder/bidsname).with_suffix('.json')
+    jsonfiles    = {bidsjson}                                       # Set -> Collect the associated json-files (for updating them later) -- possibly > 1
+    scanrows     = []
+    jsondatas    = {}
+    if converted:
+
+        # Take a snapshot of the dcm2niix output files (instead of globbing the output folder for every search), which is kept up-to-date when renaming files
+        with os.scandir(outfolder) as entries:
+            outfiles = {entry.name for entry in entries if entry.name.startswith(bidsname)}
+
+        # Replace uncropped output image with the cropped one
+        if crop:
+            for dcm2niixname in [outfile for outfile in outfiles if '_Crop_' in outfile[len(bidsname):]]:        # e.g. *_Crop_1.nii.gz. NB: The order is irrelevant (each file gets its own name)
+                stem        = dcm2niixname.split('.', 1)[0]
+                newbidsname = stem.rsplit('_Crop_', 1)[0] + dcm2niixname[len(stem):]
+                LOGGER.info(f"Found dcm2niix _Crop_ postfix, replacing original file\n{outfolder/dcm2niixname} ->\n{outfolder/newbidsname}")
+                os.replace(outfolder/dcm2niixname, outfolder/newbidsname)
+                outfiles.discard(dcm2niixname)
+                outfiles.add(newbidsname)
+
+        # Rename all files that got additional postfixes from dcm2niix. See: https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md
+        dcm2niixpostfixes = ('_c', '_i', '_Eq', '_real', '_imaginary', '_MoCo', '_t', '_Tilt', '_e', '_ph')
+        postfixpatterns   = [f"*{dcm2niixpostfix}*.nii*" for dcm2niixpostfix in dcm2niixpostfixes]
+        dcm2niixfiles     = sorted(outfolder/outfile for outfile in outfiles if any(fnmatch(outfile[len(bidsname):], pattern) for pattern in postfixpatterns))
+        if not bidsjson.is_file() and dcm2niixfiles:                                                        # Possibly renamed by dcm2niix, e.g. with multi-echo data (but not always for the first echo)
+            jsonfiles.discard(bidsjson)
+        for dcm2niixfile in dcm2niixfiles:
+            oldstem     = dcm2niixfile.name.split('.', 1)[0]
+            postfixes   = oldstem[len(bidsname):].split('_')[1:]
+            newbidsname = dcm2niixfile.name                                                                 # Strip the additional postfixes and assign them to bids entities in the for-loop below
+            for postfix in postfixes:                                                                       # dcm2niix postfixes _c%d, _e%d and _ph (and any combination of these in that order) are for multi-coil data, multi-echo data and phase data
+
+                # Patch the echo entity in the newbidsname with the dcm2niix echo info                      # NB: We can't rely on the bids-entity info here because manufacturers can e.g. put multiple echos in one series / run-folder
+                if 'echo' in run['bids'] and postfix.startswith('e'):
+                    echonr = f"_{postfix}".replace('_e','')                                                 # E.g. postfix='e1'
+                    if not echonr:
+                        echonr = '1'
+                    if echonr.isalpha():
+                        LOGGER.error(f"Unexpected postix '{postfix}' found in {dcm2niixfile}")
+                        newbidsname = bids.get_bidsvalue(newbidsname, 'dummy', postfix)                     # Append the unknown postfix to the acq-label
+                    else:
+                        newbidsname = bids.insert_bidskeyval(newbidsname, 'echo', str(int(echonr)))         # In contrast to other labels, run and echo labels MUST be integers. Those labels MAY include zero padding, but this is NOT RECOMMENDED to maintain their uniqueness
+
+                # Patch the phase entity in the newbidsname with the dcm2niix mag/phase info
+                elif 'part' in run['bids'] and postfix in ('ph','real','imaginary'):                        # e.g. part: ['', 'mag', 'phase', 'real', 'imag', 0]
+                    if postfix == 'ph':
+                        newbidsname = bids.insert_bidskeyval(newbidsname, 'part', 'phase')
+                    if postfix == 'real':
+                        newbidsname = bids.insert_bidskeyval(newbidsname, 'part', 'real')
+                    if postfix == 'imaginary':
+                        newbidsname = bids.insert_bidskeyval(newbidsname, 'part', 'imag')
+
+                # Patch fieldmap images (NB: datatype=='fmap' is too broad, see the fmap.yaml file)
+                elif run['bids']['suffix'] in fmapsuffixes:
+                    if len(dcm2niixfiles) not in (1, 2, 3, 4):                                              # Phase / echo data may be stored in the same data source / run folder
+                        LOGGER.debug(f"Unknown fieldmap {outfolder/bidsname} for '{postfix}'")
+                    for old, new, nfiles in _FMAP_RENAMES:
+                        if old in newbidsname and (nfiles is None or len(dcm2niixfiles) in nfiles):
+                            newbidsname = newbidsname.replace(old, new)
+
+                # Append the dcm2niix info to acq-label, may need to be improved / elaborated for future BIDS standards, supporting multi-coil data
+                else:
+                    newbidsname = bids.get_bidsvalue(newbidsname, 'dummy', postfix)
+
+                # Remove the added postfix from the new bidsname
+                newbidsname = newbidsname.replace(f"_{postfix}_",'_')                                       # If it is not last
+                newbidsname = newbidsname.replace(f"_{postfix}.",'.')                                       # If it is last
+
+            # Save the nifti file with a new name
+            if runindex.startswith('<<') and runindex.endswith('>>'):
+                newbidsname = bids.increment_runindex(outfolder, newbidsname, '')                           # Update the runindex now that the acq-label has changed
+            newbidsfile = outfolder/newbidsname
+            LOGGER.info(f"Found dcm2niix {postfixes} postfixes, renaming\n{dcm2niixfile} ->\n{newbidsfile}")
+            if newbidsfile.is_file():
+                LOGGER.warning(f"Overwriting existing {newbidsfile} file -- check your results carefully!")
+            dcm2niixfile.replace(newbidsfile)
+            outfiles.discard(dcm2niixfile.name)
+            outfiles.add(newbidsfile.name)
+
+            # Rename all associated files (i.e. the json-, bval- and bvec-files)
+            newstem     = newbidsfile.name.split('.', 1)[0]
+            oldjsonfile = outfolder/(oldstem + '.json')
+            newjsonfile = outfolder/(newstem + '.json')
+            if not oldjsonfile.is_file():
+                LOGGER.warning(f"Unexpected file conversion result: {oldjsonfile} not found")
+            else:
+                jsonfiles.discard(oldjsonfile)
+                jsonfiles.add(newjsonfile)
+            for oldname in [outfile for outfile in outfiles if outfile.startswith(oldstem + '.')]:
+                newname = newstem + oldname[len(oldstem):]
+                os.replace(outfolder/oldname, outfolder/newname)
+                outfiles.discard(oldname)
+                outfiles.add(newname)
+
+    # Loop over and adapt all the newly produced json files and write to the scans.tsv file (NB: assumes every nifti-file comes with a json-file)
+    for jsonfile in sorted(jsonfiles):
+
+        # Load the json meta-data
+        jsondata = bids.load_json(jsonfile)
+
+        # Add the TaskName to the meta-data
+        if datatype == 'func' and 'TaskName' not in jsondata:
+            jsondata['TaskName'] = run['bids']['task']
+
+        # Add the TracerName and TaskName to the meta-data
+        elif datatype == 'pet' and 'TracerName' not in jsondata:
+            jsondata['TracerName'] = run['bids']['trc']
+
+        # Add all the meta data to the json-file except `IntendedFor`, which is handled separately later
+        for metakey, metaval in run['meta'].items():
+            if metakey != 'IntendedFor':
+                LOGGER.info(f"Adding '{metakey}: {metaval}' to: {jsonfile}")
+                if isinstance(metaval, str) and '<' in metaval:                                         # Only <dynamic> values need to be evaluated
+                    metaval = datasource.dynamicvalue(metaval, cleanup=False, runtime=True)
+            jsondata[metakey] = metaval
+        bids.save_json(jsondata, jsonfile)
+        if datatype in ('fmap', 'func'):
+            jsondatas[jsonfile] = dict(jsondata)                                                        # NB: Copy it, because the AcquisitionTime may be added to jsondata below
+
+        # Parse the acquisition time from the json file or else from the source header (NB: assuming the source file represents the first acquisition)
+        outputfile = [file for file in jsonfile.parent.glob(jsonfile.stem + '.*') if file.suffix in ('.nii','.gz')]     # Find the corresponding nifti/tsv.gz file (there should be only one, let's not make assumptions about the .gz extension)
+        if not outputfile:
+            LOGGER.exception(f"No data-file found with {jsonfile} when updating the scans.tsv file")
+        elif datatype not in bidsmap['Options']['bidscoin']['bidsignore'] and not isderivative:
+            if 'AcquisitionTime' not in jsondata or not jsondata['AcquisitionTime']:
+                jsondata['AcquisitionTime'] = datasource.attributes('AcquisitionTime')                  # DICOM
+            if not jsondata['AcquisitionTime']:
+                jsondata['AcquisitionTime'] = datasource.attributes('exam_date')                        # PAR/XML
+            try:
+                acq_time = bids.parse_datetime(jsondata['AcquisitionTime'])
+                acq_time = '1925-01-01T' + acq_time.strftime('%H:%M:%S')                                # Privacy protection (see BIDS specification)
+            except Exception as jsonerror:
+                LOGGER.warning(f"Could not parse the acquisition time from: {sourcefile}\n{jsonerror}")
+                acq_time = 'n/a'
+            scanpath = outputfile[0].relative_to(bidsses)
+            scanrows.append((scanpath.as_posix(), acq_time))
+
+    return scanrows, jsondatas
+
+
+def _convert_runs(rungroups: list, plugin: dict, bidsmap: dict, bidsfolder: Path, bidsses: Path, subid: str, sesid: str, manufacturer: str) -> Tuple[list, dict]:
+    """
+    Converts the source-files of the run groups to nifti-files in the BIDS session-folder. The runs of a group are
+    converted in order, so that runs that get the same bidsname also get proper (increasing) run and echo indices. The
+    groups are independent, so in each round the next run of every group is converted, with the (slow) dcm2niix
+    conversions running concurrently. Everything else (naming, post-processing and logging) is done in this thread
+
+    :param rungroups:       The groups of runs that are converted, with the (source, sourcefile, run, datatype) tuples of the runs
+    :param plugin:          The philips2bids plugin dictionary with the plugin options
+    :param bidsmap:         The full mapping heuristics from the bidsmap YAML-file
+    :param bidsfolder:      The full-path name of the BIDS root-folder
+    :param bidsses:         The full-path name of the BIDS session-folder
+    :param subid:           The subject identifier, i.e. name of the subject folder (e.g. 'sub-001')
+    :param sesid:           The optional session identifier, i.e. name of the session folder (e.g. 'ses-01')
+    :param manufacturer:    The manufacturer of the scanner (used for the derivatives folder)
+    :return:                The (filename, acq_time) rows for the scans.tsv file and the written fmap and func json meta-data (for post-processing them without reading them back from disk)
+    """
+
+    # Get the (run-invariant) plugin options (NB: the derivatives suffixes are stored per datatype)
+    dcm2niixpath = plugin['philips2bids'].get('path','')
+    dcm2niixargs = plugin['philips2bids'].get('args','')
+    derivatives  = {}
+
+    scanrows  = []
+    jsondatas = {}
+    for runs in zip_longest(*rungroups):
+        runs = [runitem for runitem in runs if runitem]             # The next run of every group that has runs left
+
+        # Name the runs and compose the dcm2niix commands
+        outputs  = []
+        commands = {}
+        for source, sourcefile, run, datatype in runs:
+            if datatype not in derivatives:
+                derivatives[datatype] = set(bids.get_derivatives(datatype))
+            isderivative = run['bids']['suffix'] in derivatives[datatype]
+            if isderivative:
+                outfolder = bidsfolder/'derivatives'/manufacturer.replace(' ','')/subid/sesid/datatype
+            else:
+                outfolder = bidsses/datatype
+            bidsname = _prepare_run(source, sourcefile, run, outfolder, subid, sesid)
+            outputs.append((outfolder, bidsname, isderivative))
+            if run['bids']['suffix'] != 'physio':
+                commands[source] = f'{dcm2niixpath}dcm2niix {dcm2niixargs} -f "{bidsname}" -o "{outfolder}" "{source}"'
+
+        # Convert the source-files in the run folders to nifti's in the BIDS-folder
+        success = dict(zip(commands, bidscoin.run_commands(list(commands.values()))))
+
+        # Rename and add meta-data to the output files
+        for (source, sourcefile, run, datatype), (outfolder, bidsname, isderivative) in zip(runs, outputs):
+            if success.get(source, True):
+                runrows, rundatas = _postprocess_run(sourcefile, run, datatype, outfolder, bidsname, source in commands, '-x y' in dcm2niixargs, isderivative, bidsmap, bidsses)
+                scanrows.extend(runrows)
+                jsondatas.update(rundatas)
+
+    return scanrows, jsondatas
+
+
+def _update_participants(bidsfolder: Path, subid: str, sesid: str, dataformat: str, sourcefile: Path) -> None:
+    """
+    Adds the personal data (e.g. Age, Sex) from the source header to the participants.tsv and participants.json files
+    in the bidsfolder. Only the data from the first session of a subject is stored
+
+    :param bidsfolder:  The full-path name of the BIDS root-folder
+    :param subid:       The BIDS subject identifier, i.e. sub-<label>
+    :param sesid:       The BIDS session identifier, i.e. ses-<label>
+    :param dataformat:  The dataformat of the sourcefile, e.g. DICOM or PAR
+    :param sourcefile:  The (DICOM) source file from which the personal data is read
+    :return:            Nothing
+    """
+
+    # Read the participant_table first, i.e. don't read any personal data if it is not going to be stored
+    participants_tsv  = bidsfolder/'participants.tsv'
+    participants_json = participants_tsv.with_suffix('.json')
+    participants_text = participants_tsv.read_text(encoding='utf-8') if participants_tsv.is_file() else ''
+    participants_rows = list(csv.reader(participants_text.splitlines(), delimiter='\t'))
+    participants_cols = participants_rows[0] if participants_rows else []
+    participants_ids  = {row[0] for row in participants_rows[1:] if row}
+    if subid in participants_ids and 'session_id' in participants_cols:
+        sessioncol = participants_cols.index('session_id')
+        if any(row[0] == subid and len(row) > sessioncol and row[sessioncol] not in ('', 'n/a') for row in participants_rows[1:] if row):
+            return                                      # Only take data from the first session -> BIDS specification
+
+    # Collect personal data from a source header (PAR/XML does not contain personal info)
+    personals = {}
+    if sesid and 'session_id' not in personals:
+        personals['session_id'] = sesid
+    if dataformat=='DICOM' and sourcefile.name:
+        dicomfields = bids.get_personalfields(sourcefile)
+        age = str(dicomfields['PatientAge'])                        # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
+        ageunit = _AGEUNITS.get(age[-1:])
+        if ageunit:
+            personals['age'] = str(int(float(age[:-1])/ageunit))
+        elif age:
+            personals['age'] = age
+        personals['sex']     = str(dicomfields['PatientSex'])
+        personals['size']    = str(dicomfields['PatientSize'])
+        personals['weight']  = str(dicomfields['PatientWeight'])
+
+    # Store the collected personals in the participant_table
+    if participants_json.is_file():
+        participants_dict = bids.load_json(participants_json)
+    else:
+        participants_dict = {'participant_id': {'Description': 'Unique participant identifier'}}
+    newkeys = False
+    for key in personals:           # TODO: Check that only values that are consistent over sessions go in the participants.tsv file, otherwise put them in a sessions.tsv file
+        if key not in participants_dict:
+            newkeys = True
+            participants_dict[key] = dict(LongName     = 'Long (unabbreviated) name of the column',
+                                          Description  = 'Description of the the column',
+                                          Levels       = dict(Key='Value (This is for categorical variables: a dictionary of possible values (keys) and their descriptions (values))'),
+                                          Units        = 'Measurement units. [<prefix symbol>]<unit symbol> format following the SI standard is RECOMMENDED')
+
+    # Write the collected data to the participant files
+    LOGGER.info(f"Writing {subid} subject data to: {participants_tsv}")
+    if participants_cols[:1] == ['participant_id'] and subid not in participants_ids and set(personals).issubset(participants_cols):
+        participants_row = [subid] + [str(personals.get(key) or 'n/a') for key in participants_cols[1:]]
+        with participants_tsv.open('a', newline='', encoding='utf-8') as tsv_fid:       # A new subject without new keys -> just append its row
+            if not participants_text.endswith('\n'):
+                tsv_fid.write('\n')
+            csv.writer(tsv_fid, delimiter='\t', lineterminator='\n').writerow(participants_row)
+    elif personals:
+        participants_cols = (participants_cols or ['participant_id']) + [key for key in personals if key not in participants_cols]
+        tablerows         = [row for row in participants_rows[1:] if row]
+        participants      = {row[0]: dict(zip(participants_cols, row)) for row in tablerows}
+        if len(participants) < len(tablerows):
+            raise ValueError(f"Duplicate participant_id values found in: {participants_tsv}")
+        participants.setdefault(subid, {'participant_id': subid}).update(personals)
+        with participants_tsv.open('w', newline='', encoding='utf-8') as tsv_fid:              # The table is tiny, so just (re)write it with the csv library
+            tsv_writer = csv.writer(tsv_fid, delimiter='\t', lineterminator='\n')
+            tsv_writer.writerow(participants_cols)
+            tsv_writer.writerows([str(participant.get(key) or 'n/a') for key in participants_cols] for participant in participants.values())
+    if newkeys:
+        LOGGER.info(f"Writing subject data dictionary to: {participants_json}")
+        bids.save_json(participants_dict, participants_json)
+
+
 def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
     """
     The bidscoiner plugin to convert the session DICOM and PAR/REC source-files into BIDS-valid nifti-files in the
@@ -190,13 +602,10 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
         LOGGER.warning(f"Existing BIDS output-directory found, which may result in duplicate data (with increased run-index). Make sure {bidsses} was cleaned-up from old data before (re)running the bidscoiner")
     bidsses.mkdir(parents=True, exist_ok=True)
     scans_tsv = bidsses/f"{subid}{bids.add_prefix('_',sesid)}_scans.tsv"
-    if scans_tsv.is_file():
-        scans_table = pd.read_csv(scans_tsv, sep='\t', index_col='filename')
-    else:
-        scans_table = pd.DataFrame(columns=['acq_time'], dtype='str')
-        scans_table.index.name = 'filename'
+    scans_rows = {}                                                     # The acq_time values per filename, which are added to the scans.tsv file in one go
 
-    # Process all the source files or run subfolders
+    # Collect the runs that are converted, grouped by the datatype and suffix (i.e. the runs that can get the same bidsname. NB: dcm2niix can produce all fmap suffixes)
+    rungroups  = {}
     sourcefile = Path()
     for source in sources:
 
@@ -226,218 +635,32 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
             LOGGER.error(f"Skipping unknown '{datatype}' run: {sourcefile}\n-> Re-run the bidsmapper and delete {bidsses} to solve this warning")
             continue
 
-        LOGGER.info(f"Processing: {source}")
-
-        # Create the BIDS session/datatype output folder
-        if run['bids']['suffix'] in bids.get_derivatives(datatype):
-            outfolder = bidsfolder/'derivatives'/manufacturer.replace(' ','')/subid/sesid/datatype
-        else:
-            outfolder = bidsses/datatype
-        outfolder.mkdir(parents=True, exist_ok=True)
-
-        # Compose the BIDS filename using the matched run
-        bidsname  = bids.get_bidsname(subid, sesid, run, runtime=True)
-        runindex  = run['bids'].get('run', '')
-        if runindex.startswith('<<') and runindex.endswith('>>'):
-            bidsname = bids.increment_runindex(outfolder, bidsname)
-        jsonfiles = [(outfolder/bidsname).with_suffix('.json')]     # List -> Collect the associated json-files (for updating them later) -- possibly > 1
-
-        # Check if file already exists (-> e.g. when a static runindex is used)
-        if (outfolder/bidsname).with_suffix('.json').is_file():
-            LOGGER.warning(f"{outfolder/bidsname}.* already exists and will be deleted -- check your results carefully!")
-            for ext in ('.nii.gz', '.nii', '.json', '.bval', '.bvec', '.tsv.gz'):
-                (outfolder/bidsname).with_suffix(ext).unlink(missing_ok=True)
-
-        # Convert physiological log files (dcm2niix can't handle these)
-        if run['bids']['suffix'] == 'physio':
-            if bids.get_dicomfile(source, 2).name:                  # TODO: issue warning or support PAR
-                LOGGER.warning(f"Found > 1 DICOM file in {source}, using: {sourcefile}")
-            physiodata = physio.readphysio(sourcefile)
-            physio.physio2tsv(physiodata, outfolder/bidsname)
-
-        # Convert the source-files in the run folder to nifti's in the BIDS-folder
-        else:
-            command = '{path}dcm2niix {args} -f "{filename}" -o "{outfolder}" "{source}"'.format(
-                path      = plugin['philips2bids'].get('path',''),
-                args      = plugin['philips2bids'].get('args',''),
-                filename  = bidsname,
-                outfolder = outfolder,
-                source    = source)
-            if not bidscoin.run_command(command):
-                continue
-
-            # Replace uncropped output image with the cropped one
-            if '-x y' in plugin['philips2bids'].get('args',''):
-                for dcm2niixfile in sorted(outfolder.glob(bidsname + '*_Crop_*')):                              # e.g. *_Crop_1.nii.gz
-                    ext         = ''.join(dcm2niixfile.suffixes)
-                    newbidsfile = str(dcm2niixfile).rsplit(ext,1)[0].rsplit('_Crop_',1)[0] + ext
-                    LOGGER.info(f"Found dcm2niix _Crop_ postfix, replacing original file\n{dcm2niixfile} ->\n{newbidsfile}")
-                    dcm2niixfile.replace(newbidsfile)
-
-            # Rename all files that got additional postfixes from dcm2niix. See: https://github.com/rordenlab/dcm2niix/blob/master/FILENAMING.md
-            dcm2niixpostfixes = ('_c', '_i', '_Eq', '_real', '_imaginary', '_MoCo', '_t', '_Tilt', '_e', '_ph')
-            dcm2niixfiles     = sorted(set([dcm2niixfile for dcm2niixpostfix in dcm2niixpostfixes for dcm2niixfile in outfolder.glob(f"{bidsname}*{dcm2niixpostfix}*.nii*")]))
-            if not jsonfiles[0].is_file() and dcm2niixfiles:                                                    # Possibly renamed by dcm2niix, e.g. with multi-echo data (but not always for the first echo)
-                jsonfiles.pop(0)
-            for dcm2niixfile in dcm2niixfiles:
-                ext         = ''.join(dcm2niixfile.suffixes)
-                postfixes   = str(dcm2niixfile).split(bidsname)[1].rsplit(ext)[0].split('_')[1:]
-                newbidsname = dcm2niixfile.name                                                                 # Strip the additional postfixes and assign them to bids entities in the for-loop below
-                for postfix in postfixes:                                                                       # dcm2niix postfixes _c%d, _e%d and _ph (and any combination of these in that order) are for multi-coil data, multi-echo data and phase data
-
-                    # Patch the echo entity in the newbidsname with the dcm2niix echo info                      # NB: We can't rely on the bids-entity info here because manufacturers can e.g. put multiple echos in one series / run-folder
-                    if 'echo' in run['bids'] and postfix.startswith('e'):
-                        echonr = f"_{postfix}".replace('_e','')                                                 # E.g. postfix='e1'
-                        if not echonr:
-                            echonr = '1'
-                        if echonr.isalpha():
-                            LOGGER.error(f"Unexpected postix '{postfix}' found in {dcm2niixfile}")
-                            newbidsname = bids.get_bidsvalue(newbidsname, 'dummy', postfix)                     # Append the unknown postfix to the acq-label
-                        else:
-                            newbidsname = bids.insert_bidskeyval(newbidsname, 'echo', str(int(echonr)))         # In contrast to other labels, run and echo labels MUST be integers. Those labels MAY include zero padding, but this is NOT RECOMMENDED to maintain their uniqueness
-
-                    # Patch the phase entity in the newbidsname with the dcm2niix mag/phase info
-                    elif 'part' in run['bids'] and postfix in ('ph','real','imaginary'):                        # e.g. part: ['', 'mag', 'phase', 'real', 'imag', 0]
-                        if postfix == 'ph':
-                            newbidsname = bids.insert_bidskeyval(newbidsname, 'part', 'phase')
-                        if postfix == 'real':
-                            newbidsname = bids.insert_bidskeyval(newbidsname, 'part', 'real')
-                        if postfix == 'imaginary':
-                            newbidsname = bids.insert_bidskeyval(newbidsname, 'part', 'imag')
-
-                    # Patch fieldmap images (NB: datatype=='fmap' is too broad, see the fmap.yaml file)
-                    elif run['bids']['suffix'] in bids.bidsdatatypes['fmap'][0]['suffixes']:                    # i.e. in ('magnitude','magnitude1','magnitude2','phase1','phase2','phasediff','fieldmap'). TODO: Make this robust for future BIDS versions
-                        if len(dcm2niixfiles) not in (1, 2, 3, 4):                                              # Phase / echo data may be stored in the same data source / run folder
-                            LOGGER.debug(f"Unknown fieldmap {outfolder/bidsname} for '{postfix}'")
-                        newbidsname = newbidsname.replace('_magnitude1a',    '_magnitude2')                     # First catch this potential weird / rare case
-                        newbidsname = newbidsname.replace('_magnitude1_pha', '_phase2')                         # First catch this potential weird / rare case
-                        newbidsname = newbidsname.replace('_magnitude1_e1',  '_magnitude1')                     # Case 2 = Two phase and magnitude images
-                        newbidsname = newbidsname.replace('_magnitude1_e2',  '_magnitude2')                     # Case 2: This can happen when the e2 image is stored in the same directory as the e1 image, but with the e2 listed first
-                        newbidsname = newbidsname.replace('_magnitude2_e1',  '_magnitude1')                     # Case 2: This can happen when the e2 image is stored in the same directory as the e1 image, but with the e2 listed first
-                        newbidsname = newbidsname.replace('_magnitude2_e2',  '_magnitude2')                     # Case 2
-                        if len(dcm2niixfiles) in (2,3):                                                         # Case 1 = One or two magnitude + one phasediff image
-                            newbidsname = newbidsname.replace('_magnitude1_ph', '_phasediff')
-                            newbidsname = newbidsname.replace('_magnitude2_ph', '_phasediff')
-                        newbidsname = newbidsname.replace('_phasediff_e1',   '_phasediff')                      # Case 1
-                        newbidsname = newbidsname.replace('_phasediff_e2',   '_phasediff')                      # Case 1
-                        newbidsname = newbidsname.replace('_phasediff_ph',   '_phasediff')                      # Case 1
-                        newbidsname = newbidsname.replace('_magnitude1_ph',  '_phase1')                         # Case 2: One or two magnitude and phase images in one folder / datasource
-                        newbidsname = newbidsname.replace('_magnitude2_ph',  '_phase2')                         # Case 2: Two magnitude + two phase images in one folder / datasource
-                        newbidsname = newbidsname.replace('_phase1_e1',      '_phase1')                         # Case 2
-                        newbidsname = newbidsname.replace('_phase1_e2',      '_phase2')                         # Case 2: This can happen when the e2 image is stored in the same directory as the e1 image, but with the e2 listed first
-                        newbidsname = newbidsname.replace('_phase2_e1',      '_phase1')                         # Case 2: This can happen when the e2 image is stored in the same directory as the e1 image, but with the e2 listed first
-                        newbidsname = newbidsname.replace('_phase2_e2',      '_phase2')                         # Case 2
-                        newbidsname = newbidsname.replace('_phase1_ph',      '_phase1')                         # Case 2: One or two magnitude and phase images in one folder / datasource
-                        newbidsname = newbidsname.replace('_phase2_ph',      '_phase2')                         # Case 2: Two magnitude + two phase images in one folder / datasource
-                        newbidsname = newbidsname.replace('_magnitude_e1',   '_magnitude')                      # Case 3 = One magnitude + one fieldmap image
-                        if len(dcm2niixfiles) == 2:
-                            newbidsname = newbidsname.replace('_fieldmap_e1', '_magnitude')                     # Case 3: One magnitude + one fieldmap image in one folder / datasource
-                        newbidsname = newbidsname.replace('_fieldmap_e1',    '_fieldmap')                       # Case 3
-                        newbidsname = newbidsname.replace('_magnitude_ph',   '_fieldmap')                       # Case 3: One magnitude + one fieldmap image in one folder / datasource
-                        newbidsname = newbidsname.replace('_fieldmap_ph',    '_fieldmap')                       # Case 3
-
-                    # Append the dcm2niix info to acq-label, may need to be improved / elaborated for future BIDS standards, supporting multi-coil data
-                    else:
-                        newbidsname = bids.get_bidsvalue(newbidsname, 'dummy', postfix)
-
-                    # Remove the added postfix from the new bidsname
-                    newbidsname = newbidsname.replace(f"_{postfix}_",'_')                                       # If it is not last
-                    newbidsname = newbidsname.replace(f"_{postfix}.",'.')                                       # If it is last
-
-                # Save the nifti file with a new name
-                if runindex.startswith('<<') and runindex.endswith('>>'):
-                    newbidsname = bids.increment_runindex(outfolder, newbidsname, '')                           # Update the runindex now that the acq-label has changed
-                newbidsfile = outfolder/newbidsname
-                LOGGER.info(f"Found dcm2niix {postfixes} postfixes, renaming\n{dcm2niixfile} ->\n{newbidsfile}")
-                if newbidsfile.is_file():
-                    LOGGER.warning(f"Overwriting existing {newbidsfile} file -- check your results carefully!")
-                dcm2niixfile.replace(newbidsfile)
-
-                # Rename all associated files (i.e. the json-, bval- and bvec-files)
-                oldjsonfile = dcm2niixfile.with_suffix('').with_suffix('.json')
-                newjsonfile = newbidsfile.with_suffix('').with_suffix('.json')
-                if not oldjsonfile.is_file():
-                    LOGGER.warning(f"Unexpected file conversion result: {oldjsonfile} not found")
-                else:
-                    if oldjsonfile in jsonfiles:
-                        jsonfiles.remove(oldjsonfile)
-                    if newjsonfile not in jsonfiles:
-                        jsonfiles.append(newjsonfile)
-                for oldfile in outfolder.glob(dcm2niixfile.with_suffix('').stem + '.*'):
-                    oldfile.replace(newjsonfile.with_suffix(''.join(oldfile.suffixes)))
-
-        # Loop over and adapt all the newly produced json files and write to the scans.tsv file (NB: assumes every nifti-file comes with a json-file)
-        for jsonfile in sorted(set(jsonfiles)):
-
-            # Load the json meta-data
-            with jsonfile.open('r') as json_fid:
-                jsondata = json.load(json_fid)
-
-            # Add the TaskName to the meta-data
-            if datatype == 'func' and 'TaskName' not in jsondata:
-                jsondata['TaskName'] = run['bids']['task']
-
-            # Add the TracerName and TaskName to the meta-data
-            elif datatype == 'pet' and 'TracerName' not in jsondata:
-                jsondata['TracerName'] = run['bids']['trc']
-
-            # Add all the meta data to the json-file except `IntendedFor`, which is handled separately later
-            for metakey, metaval in run['meta'].items():
-                if metakey != 'IntendedFor':
-                    LOGGER.info(f"Adding '{metakey}: {metaval}' to: {jsonfile}")
-                    metaval = datasource.dynamicvalue(metaval, cleanup=False, runtime=True)
-                jsondata[metakey] = metaval
-            with jsonfile.open('w') as json_fid:
-                json.dump(jsondata, json_fid, indent=4)
-
-            # Parse the acquisition time from the json file or else from the source header (NB: assuming the source file represents the first acquisition)
-            outputfile = [file for file in jsonfile.parent.glob(jsonfile.stem + '.*') if file.suffix in ('.nii','.gz')]     # Find the corresponding nifti/tsv.gz file (there should be only one, let's not make assumptions about the .gz extension)
-            if not outputfile:
-                LOGGER.exception(f"No data-file found with {jsonfile} when updating {scans_tsv}")
-            elif datatype not in bidsmap['Options']['bidscoin']['bidsignore'] and not run['bids']['suffix'] in bids.get_derivatives(datatype):
-                if 'AcquisitionTime' not in jsondata or not jsondata['AcquisitionTime']:
-                    jsondata['AcquisitionTime'] = datasource.attributes('AcquisitionTime')                  # DICOM
-                if not jsondata['AcquisitionTime']:
-                    jsondata['AcquisitionTime'] = datasource.attributes('exam_date')                        # PAR/XML
-                try:
-                    acq_time = dateutil.parser.parse(jsondata['AcquisitionTime'])
-                    acq_time = '1925-01-01T' + acq_time.strftime('%H:%M:%S')                                # Privacy protection (see BIDS specification)
-                except Exception as jsonerror:
-                    LOGGER.warning(f"Could not parse the acquisition time from: {sourcefile}\n{jsonerror}")
-                    acq_time = 'n/a'
-                scanpath = outputfile[0].relative_to(bidsses)
-                scans_table.loc[scanpath.as_posix(), 'acq_time'] = acq_time
+        rungroups.setdefault(datatype if datatype == 'fmap' else (datatype, run['bids']['suffix']), []).append((source, sourcefile, run, datatype))
+
+    # Convert the run groups (the runs within a group are converted serially, to get proper run/echo-indices)
+    scanrows, jsondatas = _convert_runs(list(rungroups.values()), plugin, bidsmap, bidsfolder, bidsses, subid, sesid, manufacturer)     # NB: jsondatas has the meta-data of the produced fmap and func json-files
+    scans_rows.update(scanrows)
 
     # Write the scans_table to disk
-    LOGGER.info(f"Writing acquisition time data to: {scans_tsv}")
-    scans_table.sort_values(by=['acq_time','filename'], inplace=True)
-    scans_table.to_csv(scans_tsv, sep='\t', encoding='utf-8')
+    bids.update_scans_tsv(scans_tsv, scans_rows)
 
     # Add IntendedFor search results and TE1+TE2 meta-data to the fieldmap json-files. This has been postponed until all datatypes have been processed (i.e. so that all target images are indeed on disk)
     if (bidsses/'fmap').is_dir():
+
+        # Walk the session folder only once for all IntendedFor searches, i.e. store the (name, path relative to the subject folder) of all imaging files
+        sessionniis     = [(niifile.name, niifile.relative_to(bidsfolder/subid)) for niifile in sorted(Path(entry.path) for entry in bids.scandir_recursive(bidsses) if '.nii' in entry.name)]
+        selectormatches = {}                                                    # The search results per selector (selectors are typically the same for many fieldmaps)
+
+        # Get all the existing meta-data first (from memory if it was just produced), i.e. such that the magnitude data can also be taken from memory
+        fmapdata = {}
         for jsonfile in sorted((bidsses/'fmap').glob('sub-*.json')):
+            fmapdata[jsonfile] = jsondatas.get(jsonfile) or bids.load_json(jsonfile)
+        fmaporig = {jsonfile: dict(jsondata) for jsonfile, jsondata in fmapdata.items()}     # A (shallow) copy of the meta-data, to see which files were modified
 
-            # Load the existing meta-data
-            with jsonfile.open('r') as json_fid:
-                jsondata = json.load(json_fid)
-            # Modify Estimated* fields and set PhaseEncodingDirection based on SeriesDescription
-            if 'EstimatedEffectiveEchoSpacing' in jsondata:
-                jsondata['EffectiveEchoSpacing']=jsondata['EstimatedEffectiveEchoSpacing']
-                del jsondata['EstimatedEffectiveEchoSpacing']
-            if 'EstimatedTotalReadoutTime' in jsondata:
-                jsondata['TotalReadoutTime']=jsondata['EstimatedTotalReadoutTime']
-                del jsondata['EstimatedTotalReadoutTime']
-            if 'SeriesDescription' in jsondata:
-                phase_encoding_regex = re.search(r'.*(?i)(AP|PA).*', jsondata['SeriesDescription'])
-                try:
-                    found_phase_encoding = phase_encoding_regex.groups()[0]
-                    print(f"found {found_phase_encoding}")
-                    jsondata['PhaseEncodingDirection'] = found_phase_encoding
-                except Exception as e:
-                    print(f"no regex match {e}")
-                    jsondata['PhaseEncodingDirection'] = 'no match'
-            
+        for jsonfile, jsondata in fmapdata.items():
 
+            # Modify Estimated* fields and set PhaseEncodingDirection based on SeriesDescription
+            postfixPHILIPS.postfix_sidecar(jsonfile, jsondata, estimated=None, phaseencoding='no match', overwrite=True)
 
             # Search for the imaging files that match the IntendedFor search criteria
             niifiles    = []
@@ -449,7 +672,10 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
                 elif not isinstance(intendedfor, list):
                     intendedfor = [intendedfor]
                 for selector in intendedfor:
-                    niifiles.extend([Path(niifile).relative_to(bidsfolder/subid) for niifile in sorted(bidsses.rglob(f"*{selector}*.nii*")) if selector])
+                    if selector and selector not in selectormatches:
+                        pattern                   = f"*{selector}*.nii*"
+                        selectormatches[selector] = [niifile for niiname, niifile in sessionniis if fnmatch(niiname, pattern)]
+                    niifiles.extend(selectormatches.get(selector, []))
 
                 # Add the IntendedFor data
                 if niifiles:
@@ -467,12 +693,10 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
                 echotime       = [None, None]
                 for n in (0,1):
                     json_magnitude[n] = jsonfile.parent/jsonfile.name.replace('_phasediff', f"_magnitude{n+1}")
-                    if not json_magnitude[n].is_file():
+                    if json_magnitude[n] not in fmapdata:
                         LOGGER.error(f"Could not find expected magnitude{n+1} image associated with: {jsonfile}")
                     else:
-                        with json_magnitude[n].open('r') as json_fid:
-                            data = json.load(json_fid)
-                        echotime[n] = data['EchoTime']
+                        echotime[n] = fmapdata[json_magnitude[n]]['EchoTime']
                 jsondata['EchoTime1'] = jsondata['EchoTime2'] = None
                 if None in echotime:
                     LOGGER.error(f"Cannot find and add valid EchoTime1={echotime[0]} and EchoTime2={echotime[1]} data to: {jsonfile}")
@@ -483,86 +707,22 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
                     jsondata['EchoTime2'] = echotime[1]
                     LOGGER.info(f"Adding EchoTime1: {echotime[0]} and EchoTime2: {echotime[1]} to {jsonfile}")
 
-            # Save the collected meta-data to disk
-            with jsonfile.open('w') as json_fid:
-                json.dump(jsondata, json_fid, indent=4)
+        # Save the modified meta-data to disk
+        _jdump_all({jsonfile: jsondata for jsonfile, jsondata in fmapdata.items() if jsondata != fmaporig[jsonfile]})
     
     if (bidsses/'func').is_dir():
+        funcdata = {}
         for jsonfile in sorted((bidsses/'func').glob('sub-*.json')):
             # Load the existing meta-data
-            with jsonfile.open('r') as json_fid:
-                jsondata = json.load(json_fid)
+            jsondata = jsondatas.get(jsonfile) or bids.load_json(jsonfile)
+            original = dict(jsondata)
             # Modify Estimated* fields and set PhaseEncodingDirection based on SeriesDescription
-            if 'EstimatedEffectiveEchoSpacing' in jsondata:
-                jsondata['EffectiveEchoSpacing']=jsondata['EstimatedEffectiveEchoSpacing']
-                del jsondata['EstimatedEffectiveEchoSpacing']
-            if 'EstimatedTotalReadoutTime' in jsondata:
-                jsondata['TotalReadoutTime']=jsondata['EstimatedTotalReadoutTime']
-                del jsondata['EstimatedTotalReadoutTime']
-            if 'SeriesDescription' in jsondata:
-                phase_encoding_regex = re.search(r'.*(?i)(AP|PA).*', jsondata['SeriesDescription'])
-                try:
-                    found_phase_encoding = phase_encoding_regex.groups()[0]
-                    print(f"found {found_phase_encoding}")
-                    jsondata['PhaseEncodingDirection'] = found_phase_encoding
-                except Exception as e:
-                    print(f"no regex match {e}")
-                    jsondata['PhaseEncodingDirection'] = 'no match'
-            
-            # Save the collected meta-data to disk
-            with jsonfile.open('w') as json_fid:
-                json.dump(jsondata, json_fid, indent=4)
-                
-    # Collect personal data from a source header (PAR/XML does not contain personal info)
-    personals = {}
-    if sesid and 'session_id' not in personals:
-        personals['session_id'] = sesid
-    if dataformat=='DICOM' and sourcefile.name:
-        age = datasource.attributes('PatientAge')                   # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
-        if age.endswith('D'):
-            personals['age'] = str(int(float(age.rstrip('D'))/365.2524))
-        elif age.endswith('W'):
-            personals['age'] = str(int(float(age.rstrip('W'))/52.1775))
-        elif age.endswith('M'):
-            personals['age'] = str(int(float(age.rstrip('M'))/12))
-        elif age.endswith('Y'):
-            personals['age'] = str(int(float(age.rstrip('Y'))))
-        elif age:
-            personals['age'] = age
-        personals['sex']     = datasource.attributes('PatientSex')
-        personals['size']    = datasource.attributes('PatientSize')
-        personals['weight']  = datasource.attributes('PatientWeight')
+            postfixPHILIPS.postfix_sidecar(jsonfile, jsondata, estimated=None, phaseencoding='no match', overwrite=True)
+            if jsondata != original:
+                funcdata[jsonfile] = jsondata
 
-    # Store the collected personals in the participant_table
-    participants_tsv  = bidsfolder/'participants.tsv'
-    participants_json = participants_tsv.with_suffix('.json')
-    if participants_tsv.is_file():
-        participants_table = pd.read_csv(participants_tsv, sep='\t')
-        participants_table.set_index(['participant_id'], verify_integrity=True, inplace=True)
-    else:
-        participants_table = pd.DataFrame()
-        participants_table.index.name = 'participant_id'
-    if subid in participants_table.index and 'session_id' in participants_table.keys() and participants_table.loc[subid, 'session_id']:
-        return                                          # Only take data from the first session -> BIDS specification
-    if participants_json.is_file():
-        with participants_json.open('r') as json_fid:
-            participants_dict = json.load(json_fid)
-    else:
-        participants_dict = {'participant_id': {'Description': 'Unique participant identifier'}}
-    newkeys = False
-    for key in personals:           # TODO: Check that only values that are consistent over sessions go in the participants.tsv file, otherwise put them in a sessions.tsv file
-        participants_table.loc[subid, key] = personals[key]
-        if key not in participants_dict:
-            newkeys = True
-            participants_dict[key] = dict(LongName     = 'Long (unabbreviated) name of the column',
-                                          Description  = 'Description of the the column',
-                                          Levels       = dict(Key='Value (This is for categorical variables: a dictionary of possible values (keys) and their descriptions (values))'),
-                                          Units        = 'Measurement units. [<prefix symbol>]<unit symbol> format following the SI standard is RECOMMENDED')
-
-    # Write the collected data to the participant files
-    LOGGER.info(f"Writing {subid} subject data to: {participants_tsv}")
-    participants_table.replace('','n/a').to_csv(participants_tsv, sep='\t', encoding='utf-8', na_rep='n/a')
-    if newkeys:
-        LOGGER.info(f"Writing subject data dictionary to: {participants_json}")
-        with participants_json.open('w') as json_fid:
-            json.dump(participants_dict, json_fid, indent=4)
+        # Save the modified meta-data to disk
+        _jdump_all(funcdata)
+                
+    # Store the personal data (from the first session) in the participants.tsv/.json files
+    _update_participants(bidsfolder, subid, sesid, dataformat, sourcefile)
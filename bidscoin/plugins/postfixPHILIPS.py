@@ -17,21 +17,62 @@ NOTE
 """
 
 import logging
+import os
+import gzip
 import dateutil.parser
 import pandas as pd
-import json
 from typing import Union
 from pathlib import Path
 import shutil
 import re
+from functools import lru_cache
 import nibabel as nib
+import numpy as np
 try:
     from bidscoin import bidscoin, bids, physio
 except ImportError:
     import bidscoin, bids, physio     # This should work if bidscoin was not pip-installed
-
 LOGGER = logging.getLogger(__name__)
 
+_PHASEENCODING_RE = re.compile(r'.*(AP|PA)', re.IGNORECASE)    # The (last) AP/PA phase encoding direction in the SeriesDescription
+
+
+_SERIESDESCRIPTION_RE = re.compile(rb'"SeriesDescription"\s*:\s*"([^"\\]*)"')    # The (unescaped) SeriesDescription value in the raw json-data
+
+GENERATEDBY = 'GeneratedBy: dcm2niix + bidscoin'                  # The value that replaces the (copied) dcm2niix Estimated* field values
+
+
+def postfix_sidecar(jsonfile: Path, jsondata: dict, estimated: Union[str, None]=GENERATEDBY, phaseencoding: str='j', overwrite: bool=False) -> None:
+    """
+    Copies the Estimated* fields (by dcm2niix) to their BIDS fields and sets the PhaseEncodingDirection based on the
+    AP/PA direction in the SeriesDescription. NB: The jsondata is modified in-place
+
+    :param jsonfile:        The full pathname of the json sidecar file (for logging)
+    :param jsondata:        The meta-data of the json sidecar file
+    :param estimated:       The value that replaces the Estimated* field values, or None to remove the Estimated* fields
+    :param phaseencoding:   The PhaseEncodingDirection that is used if the SeriesDescription has no AP/PA direction
+    :param overwrite:       If True, the PhaseEncodingDirection is (re)set from the AP/PA direction in the SeriesDescription,
+                            else an existing PhaseEncodingDirection is kept and only the fallback value is added if missing
+    :return:
+    """
+
+    for key in ('EffectiveEchoSpacing', 'TotalReadoutTime'):
+        if 'Estimated' + key in jsondata and jsondata['Estimated' + key] != estimated:     # I.e. skip the fields that were already copied before
+            if estimated is None:
+                jsondata[key] = jsondata.pop('Estimated' + key)
+            else:
+                jsondata[key] = jsondata['Estimated' + key]
+                jsondata['Estimated' + key] = estimated
+
+    if 'SeriesDescription' in jsondata and (overwrite or 'PhaseEncodingDirection' not in jsondata):
+        phase_encoding = _PHASEENCODING_RE.search(jsondata['SeriesDescription'])
+        if phase_encoding:
+            LOGGER.debug(f"Found {phase_encoding.group(1)} phase encoding direction in: {jsonfile}")
+            if overwrite:
+                jsondata['PhaseEncodingDirection'] = phase_encoding.group(1)
+        else:
+            LOGGER.warning(f"No AP/PA phase encoding direction found in: {jsonfile}, using: {phaseencoding}")
+            jsondata['PhaseEncodingDirection'] = phaseencoding
 
 
 def test(options: dict) -> bool:
@@ -105,6 +146,127 @@ def bidsmapper_plugin(session: Path, bidsmap_new: dict, bidsmap_old: dict, templ
     #LOGGER.info(f'This is a bidsmapper demo-plugin working on: {session}')
 
 
+@lru_cache()
+def _slice_timing(nrslices: int, tr: float=1.5, mbfactor: int=3) -> list:
+    """
+    Computes the (ascending, sequential) multi-band SliceTiming, i.e. the acquisition times of one band of nrslices/mbfactor
+    slices that are evenly spaced over the TR, tiled for all mbfactor bands
+
+    :param nrslices:    The total number of slices
+    :param tr:          The repetition time (in seconds)
+    :param mbfactor:    The multi-band (MB-SENSE) factor
+    :return:            The SliceTiming (in seconds, rounded to ms). NB: The list is cached, so copy it if you need to modify it
+    """
+
+    nrband = nrslices // mbfactor
+    return np.tile(np.round(np.arange(nrband) * tr / nrband, 3), mbfactor).tolist()
+
+
+def _list_sidecars(folder: Path) -> list:
+    """
+    Lists the sub-*.json sidecar files in folder. This is faster than sorted(folder.glob('sub-*.json')) because no Path
+    objects are constructed for the non-matching directory entries
+
+    :param folder:  The full pathname of the (existing) datatype folder
+    :return:        The sorted list of sidecar files
+    """
+
+    with os.scandir(folder) as entries:
+        jsonfiles = sorted(entry.path for entry in entries if entry.name.startswith('sub-') and entry.name.endswith('.json') and entry.is_file())
+
+    return [Path(jsonfile) for jsonfile in jsonfiles]
+
+
+def _load_niiheader(niifile: Path) -> nib.Nifti1Header:
+    """
+    Reads only the (348 bytes) header of a (gzipped) NIfTI file, i.e. without constructing the image and mapping its data
+
+    :param niifile: The full pathname of the .nii or .nii.gz file
+    :return:        The NIfTI header
+    """
+
+    with (gzip.open if niifile.suffix == '.gz' else open)(niifile, 'rb') as fid:
+        return nib.Nifti1Header.from_fileobj(fid)
+
+
+def _needs_processing(jsonbytes: bytes, isfunc: bool) -> bool:
+    """
+    Checks the raw json-data of a sidecar file (i.e. without parsing it) for fields that _process_sidecar() would add or
+    modify, so that the files that were already processed before can be skipped
+
+    :param jsonbytes:   The (utf-8 encoded) json-data of the sidecar file
+    :param isfunc:      True if the sidecar file is in the func folder (i.e. if SliceTiming and TaskName should be added)
+    :return:            True if the sidecar file needs to be processed
+    """
+
+    # Estimated* fields that have not been replaced by the GENERATEDBY marker yet
+    if jsonbytes.count(b'"Estimated') > jsonbytes.count(f'"{GENERATEDBY}"'.encode('utf-8')):
+        return True
+
+    # A missing PhaseEncodingDirection that can be added (i.e. if the SeriesDescription has no AP/PA direction)
+    if b'"PhaseEncodingDirection"' not in jsonbytes and b'"SeriesDescription"' in jsonbytes:
+        seriesdescription = _SERIESDESCRIPTION_RE.search(jsonbytes)
+        if not seriesdescription or not _PHASEENCODING_RE.search(seriesdescription.group(1).decode('utf-8', errors='replace')):
+            return True
+
+    return isfunc and (b'"SliceTiming"' not in jsonbytes or b'"TaskName"' not in jsonbytes)
+
+
+def _process_sidecar(jsonfile: Path, isfunc: bool, plugin: dict) -> None:
+    """
+    Adds the Philips specific meta-data (e.g. EffectiveEchoSpacing, PhaseEncodingDirection and SliceTiming) to a json
+    sidecar file
+
+    :param jsonfile:    The full pathname of the json sidecar file
+    :param isfunc:      True if the sidecar file is in the func folder (i.e. if SliceTiming and TaskName should be added)
+    :param plugin:      The postfixPHILIPS plugin dictionary with the plugin options
+    :return:
+    """
+
+    #LOGGER.warning(f'JSONS found')
+    # Skip the sidecar files that have no fields of interest (e.g. when re-running on already processed data)
+    jsonbytes = jsonfile.read_bytes()
+    if not _needs_processing(jsonbytes, isfunc):
+        return
+
+    # Load the existing meta-data
+    jsondata = bids.loads_json(jsonbytes)
+    original = dict(jsondata)                       # A (shallow) copy of the meta-data, to see if it was modified
+    # Modify Estimated* fields and set PhaseEncodingDirection based on SeriesDescription
+    postfix_sidecar(jsonfile, jsondata)
+
+    if isfunc:
+        if 'SliceTiming' not in jsondata:
+            niifile = jsonfile.with_suffix('.nii')
+            niifile_gz = jsonfile.with_suffix('.nii.gz')
+            if niifile.is_file():
+                nii_hdr  = _load_niiheader(niifile)
+            elif niifile_gz.is_file():
+                nii_hdr  = _load_niiheader(niifile_gz)
+            else:
+                LOGGER.warning(f'NIFTI not found for SliceTiming: {niifile}')
+            try:
+                nrslices = nii_hdr.get_n_slices()
+            except Exception as niierror:
+                nrslices = nii_hdr.get_data_shape()[2]
+
+            LOGGER.warning(f'nrslices: {nrslices} , adding SliceTiming to {jsonfile}')
+            if nrslices in (69, 66):
+                jsondata['SliceTiming'] = list(_slice_timing(nrslices))
+            else:
+                LOGGER.warning(f'{plugin} cannot determine SliceTiming nrslices:{nrslices} from NIFTI header for: {niifile}')
+                jsondata.pop('SliceTiming')
+        if 'TaskName' not in jsondata:
+            taskname = 'UNKNOWN'
+            LOGGER.warning(f'Empty TaskName for {jsonfile}, adding:{taskname}')
+            jsondata['TaskName'] = taskname
+
+
+    # Save the collected meta-data to disk (if it was modified)
+    if jsondata != original:
+        bids.save_json(jsondata, jsonfile)
+
+
 def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
     """
     The plugin to convert the runs in the source folder and save them in the bids folder. Each saved datafile should be
@@ -153,73 +315,23 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
     bidsses = bidsfolder/subid/sesid
 
 
-    if bidsses.is_dir():
+    if not bidsses.is_dir():
+        LOGGER.warning(f'NOTHING found -----145----- (session folder not found): {bidsses}')
+        return
+
+    bidsses_func = bidsses/'func'
+    bidsFOLDERS  = [folder for folder in (bidsses/'dwi', bidsses/'fmap', bidsses_func) if folder.is_dir()]
+    if bidsFOLDERS:
         #LOGGER.warning(f'bids dir found --- bidsses is {bidsses}')
-        bidsses_dwi = Path(bidsses / 'dwi')
-        bidsses_fmap = Path(bidsses / 'fmap')
-        bidsses_func = Path(bidsses / 'func')
-        #LOGGER.warning(f'dwi dir found --- bidsses_dwi is {bidsses_dwi}')
-        bidsFOLDERS = [bidsses_dwi, bidsses_fmap, bidsses_func]
-        for mod_dir in bidsFOLDERS:
-            for jsonfile in sorted((mod_dir).glob('sub-*.json')):
-                #LOGGER.warning(f'JSONS found')
-                # Load the existing meta-data
-                with jsonfile.open('r') as json_fid:
-                    jsondata = json.load(json_fid)
-                # Modify Estimated* fields and set PhaseEncodingDirection based on SeriesDescription
-                if 'EstimatedEffectiveEchoSpacing' in jsondata:
-                    jsondata['EffectiveEchoSpacing']=jsondata['EstimatedEffectiveEchoSpacing']
-                    jsondata['EstimatedEffectiveEchoSpacing']="GeneratedBy: dcm2niix + bidscoin"
-                if 'EstimatedTotalReadoutTime' in jsondata:
-                    jsondata['TotalReadoutTime']=jsondata['EstimatedTotalReadoutTime']
-                    jsondata['EstimatedTotalReadoutTime']="GeneratedBy: dcm2niix + bidscoin"
-                if 'PhaseEncodingDirection' not in jsondata:
-                    if 'SeriesDescription' in jsondata:
-                        phase_encoding_regex = re.search(r'.*(?i)(AP|PA).*', jsondata['SeriesDescription'])
-                        try:
-                            found_phase_encoding = phase_encoding_regex.groups()[0]
-                            LOGGER.warning(f"found_phase_encoding: {found_phase_encoding} for:{jsonfile}")
-                            #jsondata['PhaseEncodingDirection'] = found_phase_encoding
-                        except Exception as e:
-                            print(f"no regex match (e): {e}")
-                            LOGGER.warning(f'Assumed PhaseEncodingDirection PA > j for {jsonfile}')
-                            jsondata['PhaseEncodingDirection'] = 'j'
-                
-                if mod_dir == bidsses_func:
-                    if 'SliceTiming' not in jsondata:
-                        niifile = jsonfile.with_suffix('.nii')
-                        niifile_gz = jsonfile.with_suffix('.nii.gz')
-                        if niifile.is_file():
-                            nii_img  = nib.load(niifile)
-                        elif niifile_gz.is_file():
-                            nii_img  = nib.load(niifile_gz)
-                        else:
-                            LOGGER.warning(f'NIFTI not found for SliceTiming: {niifile}')
-                        nii_hdr = nii_img.header
-                        try:
-                            nrslices = nii_hdr.get_n_slices()
-                        except Exception as niierror:
-                            nrslices = nii_hdr.get_data_shape()[2]
-
-                        LOGGER.warning(f'nrslices: {nrslices} , adding SliceTiming to {jsonfile}')
-                        if nrslices == 69:
-                            jsondata['SliceTiming'] = [0.000,0.065,0.130,0.196,0.261,0.326,0.391,0.457,0.522,0.587,0.652,0.717,0.783,0.848,0.913,0.978,1.043,1.109,1.174,1.239,1.304,1.370,1.435,0.000,0.065,0.130,0.196,0.261,0.326,0.391,0.457,0.522,0.587,0.652,0.717,0.783,0.848,0.913,0.978,1.043,1.109,1.174,1.239,1.304,1.370,1.435,0.000,0.065,0.130,0.196,0.261,0.326,0.391,0.457,0.522,0.587,0.652,0.717,0.783,0.848,0.913,0.978,1.043,1.109,1.174,1.239,1.304,1.370,1.435]
-                        elif nrslices == 66:
-                            jsondata['SliceTiming'] = [0.000,0.068,0.136,0.205,0.273,0.341,0.409,0.477,0.545,0.614,0.682,0.750,0.818,0.886,0.955,1.023,1.091,1.159,1.227,1.295,1.364,1.432,0.000,0.068,0.136,0.205,0.273,0.341,0.409,0.477,0.545,0.614,0.682,0.750,0.818,0.886,0.955,1.023,1.091,1.159,1.227,1.295,1.364,1.432,0.000,0.068,0.136,0.205,0.273,0.341,0.409,0.477,0.545,0.614,0.682,0.750,0.818,0.886,0.955,1.023,1.091,1.159,1.227,1.295,1.364,1.432]
-                        else:
-                            LOGGER.warning(f'{plugin} cannot determine SliceTiming nrslices:{nrslices} from NIFTI header for: {niifile}')
-                            jsondata.pop('SliceTiming')
-                    if 'TaskName' not in jsondata:
-                        taskname = 'UNKNOWN'
-                        LOGGER.warning(f'Empty TaskName for {jsonfile}, adding:{taskname}')
-                        jsondata['TaskName'] = taskname
-
-
-                # Save the collected meta-data to disk
-                with jsonfile.open('w') as json_fid:
-                    json.dump(jsondata, json_fid, indent=4)
+
+        # Process the (independent) sidecar files in a pool of threads
+        from concurrent.futures import ThreadPoolExecutor     # NB: Only imported when needed
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [executor.submit(_process_sidecar, jsonfile, mod_dir == bidsses_func, plugin) for mod_dir in bidsFOLDERS for jsonfile in _list_sidecars(mod_dir)]
+        for future in futures:
+            future.result()                                   # NB: Raises the exceptions of the threads (if any)
     else:
-        LOGGER.warning(f'NOTHING found -----145-----')
+        LOGGER.warning(f'NOTHING found -----145----- (no dwi, fmap or func folders in): {bidsses}')
         LOGGER.warning(f'plugin is {plugin}')
 
 # TODO: comment out
@@ -0,0 +1,95 @@
+"""Shared fixtures for the bidscoin and plugin tests"""
+
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+# A fake dcm2niix that writes an (empty) nifti-file and a json sidecar file, or fails for sources named 'corrupt'
+DCM2NIIX = f"""#!{sys.executable}
+import json, sys
+from pathlib import Path
+args      = sys.argv[1:]
+source    = Path(args[-1])
+outfolder = Path(args[args.index('-o') + 1])
+filename  = args[args.index('-f') + 1]
+if source.name == 'corrupt':
+    sys.exit('Corrupt DICOM file')
+(outfolder/(filename + '.nii.gz')).write_bytes(b'')
+(outfolder/(filename + '.json')).write_text(json.dumps({{'AcquisitionTime': source.name}}))
+"""
+
+
+def write_dicom(dicomfile: Path, preamble: bool=True, seriesdescription: str='T1w') -> Path:
+    """Writes a minimal MR DICOM file with a private tag after the pixel data"""
+
+    dataset = Dataset()
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.TransferSyntaxUID          = ExplicitVRLittleEndian
+    dataset.file_meta.MediaStorageSOPClassUID    = '1.2.840.10008.5.1.4.1.1.4'
+    dataset.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dataset.SOPClassUID       = dataset.file_meta.MediaStorageSOPClassUID
+    dataset.SOPInstanceUID    = dataset.file_meta.MediaStorageSOPInstanceUID
+    dataset.Modality          = 'MR'
+    dataset.SeriesDescription = seriesdescription
+    dataset.Rows              = 2
+    dataset.Columns           = 2
+    dataset.BitsAllocated     = 16
+    dataset.BitsStored        = 16
+    dataset.HighBit           = 15
+    dataset.PixelRepresentation       = 0
+    dataset.SamplesPerPixel           = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.PixelData         = bytes(8)
+    dataset.add_new(0x7FE10010, 'LO', 'SIEMENS CSA NON-IMAGE')
+    if preamble:
+        dataset.save_as(dicomfile, enforce_file_format=True)
+    else:
+        dataset.save_as(dicomfile, implicit_vr=False, little_endian=True)
+    return dicomfile
+
+
+class ConvertRunsTestCase(unittest.TestCase):
+    """
+    The common fixture of the plugin _convert_runs() tests: a fake dcm2niix in a temporary folder and three run groups,
+    of which the second has three runs (one of which fails). The runitem() method creates a plugin specific run-item
+    """
+
+    plugin_name = ''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        tmpdir   = Path(self.tmpdir.name)
+        dcm2niix = tmpdir/'dcm2niix'
+        dcm2niix.write_text(DCM2NIIX)
+        dcm2niix.chmod(0o755)
+        self.plugin  = {self.plugin_name: {'path': f"{tmpdir}/", 'args': '-z y'}}
+        self.bidsmap = {'Options': {'bidscoin': {'bidsignore': []}, 'plugins': self.plugin}}
+        self.bidsses = tmpdir/'bids'/'sub-01'
+        self.bidsses.mkdir(parents=True)
+
+    def runitem(self, name: str, datatype: str, bidskeys: dict) -> tuple:
+        raise NotImplementedError
+
+    def rungroups(self, datatype: str, bidskeys: dict) -> list:
+        """Returns an anat, a func and a `datatype` run group, with the acquisition times of the runs as source names"""
+
+        return [[self.runitem('10:00:00', 'anat', {'suffix': 'T1w'})],
+                [self.runitem('10:10:00', 'func', {'task': 'rest', 'run': '<<1>>', 'suffix': 'bold'}),
+                 self.runitem('corrupt',  'func', {'task': 'rest', 'run': '<<1>>', 'suffix': 'bold'}),
+                 self.runitem('10:30:00', 'func', {'task': 'rest', 'run': '<<1>>', 'suffix': 'bold'})],
+                [self.runitem('10:20:00', datatype, bidskeys)]]
+
+    @staticmethod
+    def scanrows(bidsname: str) -> list:
+        """Returns the expected scans.tsv rows (in acquisition order) of the rungroups(), given the bidsname of the third group"""
+
+        return [('anat/sub-01_T1w.nii.gz',                  '1925-01-01T10:00:00'),
+                ('func/sub-01_task-rest_run-1_bold.nii.gz', '1925-01-01T10:10:00'),
+                (bidsname,                                  '1925-01-01T10:20:00'),
+                ('func/sub-01_task-rest_run-2_bold.nii.gz', '1925-01-01T10:30:00')]
@@ -0,0 +1,102 @@
+import os
+import stat
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from bidscoin import bids
+from tests.helpers import write_dicom
+
+
+class TestDicom(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_is_dicomfile(self):
+        self.assertTrue(bids.is_dicomfile(write_dicom(Path(self.tmpdir.name)/'preamble.dcm')))
+        self.assertTrue(bids.is_dicomfile(write_dicom(Path(self.tmpdir.name)/'nopreamble.dcm', preamble=False)))
+        textfile = Path(self.tmpdir.name)/'notes.txt'
+        textfile.write_text('Not a DICOM file')
+        self.assertFalse(bids.is_dicomfile(textfile))
+
+    def test_get_dicomfield(self):
+        dicomfile = write_dicom(Path(self.tmpdir.name)/'preamble.dcm')
+        self.assertEqual(bids.get_dicomfield('SeriesDescription', dicomfile), 'T1w')
+        self.assertEqual(bids.get_dicomfield('0x7FE10010', dicomfile), 'SIEMENS CSA NON-IMAGE')     # Stored after the pixel data
+
+    def test_get_personalfields(self):
+        dicomfile = write_dicom(Path(self.tmpdir.name)/'anonymized.dcm')
+        with mock.patch.object(bids, 'dcmread', wraps=bids.dcmread) as dcmread:
+            dicomfields = bids.get_personalfields(dicomfile)
+        self.assertEqual(dcmread.call_count, 1)                                         # I.e. no full read for the missing (anonymized) fields
+        self.assertEqual(dicomfields, {'PatientAge': '', 'PatientSex': '', 'PatientSize': '', 'PatientWeight': ''})
+        dataset = bids.dcmread(dicomfile)
+        dataset.PatientAge    = '030Y'
+        dataset.PatientSex    = 'F'
+        dataset.PatientWeight = '70'
+        dataset.save_as(dicomfile)
+        self.assertEqual(bids.get_personalfields(dicomfile), {'PatientAge': '030Y', 'PatientSex': 'F', 'PatientSize': '', 'PatientWeight': '70'})
+
+
+class TestSaveJson(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir  = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.jsonfile = Path(self.tmpdir.name)/'sub-01_T1w.json'
+
+    def test_roundtrip(self):
+        jsondata = {'RepetitionTime': 2.0, 'SeriesDescription': 'T1w', 'SliceTiming': [0.0, 0.5]}
+        bids.save_json(jsondata, self.jsonfile)
+        self.assertEqual(bids.load_json(self.jsonfile), jsondata)
+        self.assertEqual(os.listdir(self.tmpdir.name), [self.jsonfile.name])
+
+    def test_keep_mode(self):
+        self.jsonfile.write_text('{}')
+        self.jsonfile.chmod(0o640)
+        bids.save_json({'TaskName': 'rest'}, self.jsonfile)
+        self.assertEqual(stat.S_IMODE(self.jsonfile.stat().st_mode), 0o640)
+        self.assertEqual(bids.load_json(self.jsonfile), {'TaskName': 'rest'})
+
+    def test_cleanup_on_error(self):
+        self.jsonfile.write_text('{"TaskName": "rest"}')
+        with mock.patch('os.replace', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                bids.save_json({'TaskName': 'motor'}, self.jsonfile)
+        self.assertEqual(os.listdir(self.tmpdir.name), [self.jsonfile.name])
+        self.assertEqual(bids.load_json(self.jsonfile), {'TaskName': 'rest'})
+
+
+class TestScansTsv(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.scans_tsv = Path(self.tmpdir.name)/'sub-01_scans.tsv'
+
+    def test_new(self):
+        bids.update_scans_tsv(self.scans_tsv, {'func/sub-01_task-rest_bold.nii.gz': '1925-01-01T10:30:00',
+                                               'anat/sub-01_T1w.nii.gz':            '1925-01-01T10:00:00',
+                                               'extra_data/sub-01_foo.nii.gz':      'n/a'})
+        self.assertEqual(self.scans_tsv.read_text(), 'filename\tacq_time\n'
+                                                     'anat/sub-01_T1w.nii.gz\t1925-01-01T10:00:00\n'
+                                                     'func/sub-01_task-rest_bold.nii.gz\t1925-01-01T10:30:00\n'
+                                                     'extra_data/sub-01_foo.nii.gz\tn/a\n')
+
+    def test_update(self):
+        self.scans_tsv.write_text('filename\tacq_time\tquality\n'
+                                  'anat/sub-01_T1w.nii.gz\t1925-01-01T10:00:00\tgood\n'
+                                  'dwi/sub-01_dwi.nii.gz\t\tbad\n')
+        bids.update_scans_tsv(self.scans_tsv, {'anat/sub-01_T1w.nii.gz': '1925-01-01T11:00:00',
+                                               'func/sub-01_task-rest_bold.nii.gz': '1925-01-01T10:30:00'})
+        self.assertEqual(self.scans_tsv.read_text(), 'filename\tacq_time\tquality\n'
+                                                     'func/sub-01_task-rest_bold.nii.gz\t1925-01-01T10:30:00\tn/a\n'
+                                                     'anat/sub-01_T1w.nii.gz\t1925-01-01T11:00:00\tgood\n'
+                                                     'dwi/sub-01_dwi.nii.gz\t\tbad\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
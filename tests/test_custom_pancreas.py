@@ -0,0 +1,110 @@
+import shutil
+import tempfile
+import unittest
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+from bidscoin import bids
+from bidscoin.plugins import custom_pancreas
+from tests.helpers import ConvertRunsTestCase
+
+
+class TestLoadBidsmap(unittest.TestCase):
+
+    def test_safe_loader(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')                  # NB: E.g. reused anchors should not go unnoticed
+            bidsmap, yamlfile = custom_pancreas.load_bidsmap_custom(Path('bidsmap_sst.yaml'), report=None)
+        self.assertEqual(yamlfile, custom_pancreas.heuristics_folder/'bidsmap_sst.yaml')
+        self.assertIn('DICOM', bidsmap)
+
+    def test_cached_validation(self):
+        custom_pancreas._load_bidsmap_cached.cache_clear()
+        with mock.patch.object(custom_pancreas, 'check_bidsmap') as check_bidsmap:
+            with self.assertLogs(custom_pancreas.LOGGER, 'WARNING') as logs:
+                bidsmap1, _ = custom_pancreas.load_bidsmap_custom(Path('bidsmap_sst.yaml'))
+                bidsmap2, _ = custom_pancreas.load_bidsmap_custom(Path('bidsmap_sst.yaml'))
+        self.assertEqual(custom_pancreas._load_bidsmap_cached.cache_info().hits, 1)
+        self.assertEqual(check_bidsmap.call_count, 2)                               # I.e. also validated when it is loaded from the cache
+        self.assertEqual(sum('version conflict' in message for message in logs.output), 2)
+        self.assertIsNot(bidsmap1, bidsmap2)                                            # I.e. callers can safely modify the result
+
+
+class TestTemplate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.yamlfile = Path(self.tmpdir.name)/'bidsmap_template.yaml'
+        shutil.copy(custom_pancreas.heuristics_folder/'bidsmap_template.yaml', self.yamlfile)
+        custom_pancreas._read_template.cache_clear()
+
+    def test_memory_cache(self):
+        template1 = custom_pancreas._load_template(self.yamlfile)
+        template2 = custom_pancreas._load_template(self.yamlfile)
+        self.assertEqual(template1, template2)
+        self.assertIsNot(template1, template2)                              # I.e. callers can safely modify the result
+        self.assertEqual(custom_pancreas._read_template.cache_info().hits, 1)
+        self.assertEqual(sorted(path.name for path in Path(self.tmpdir.name).iterdir()), [self.yamlfile.name])    # I.e. no cache file is written
+
+
+class TestMatchSourcefiles(unittest.TestCase):
+
+    bidsmap = {'DICOM': {'subject': '<<SourceFilePath>>',
+                         'anat':    [{'provenance': '', 'attributes': {'SeriesDescription': 'T1w.*'}, 'bids': {'suffix': 'T1w'}}],
+                         'func':    [{'provenance': '', 'attributes': {'SeriesDescription': 'rest.*'}, 'bids': {'task': 'rest', 'suffix': 'bold'}}]}}
+    seriesdescriptions = {'T1w': 'T1w', 'T1w_rerun': 'T1w', 'rest1': 'rest', 'rest2': 'rest'}
+
+    def get_sourcevalue(self, key, sourcefile):
+        return self.seriesdescriptions[sourcefile.name]
+
+    @staticmethod
+    def get_matching_run(sourcefile, bidsmap, dataformat):
+        datatype = 'anat' if sourcefile.name.startswith('T1w') else 'func'
+        return dict(bidsmap[dataformat][datatype][0], provenance=str(sourcefile)), datatype, 0
+
+    def test_match_sourcefile(self):
+        with mock.patch.object(bids, 'get_matching_run', side_effect=self.get_matching_run):
+            run, datatype, index = custom_pancreas._match_sourcefile(Path('T1w'), self.bidsmap, 'DICOM')     # I.e. also outside a worker pool
+        self.assertEqual((run['provenance'], datatype, index), ('T1w', 'anat', 0))
+
+    def test_fingerprint_dedup(self):
+        sourcefiles = {Path('source')/name: Path('source')/name/name for name in self.seriesdescriptions}
+        with mock.patch.object(bids, 'get_sourcevalue', create=True, side_effect=self.get_sourcevalue), \
+             mock.patch.object(bids, 'get_matching_run', side_effect=self.get_matching_run) as get_matching_run, \
+             mock.patch('concurrent.futures.ProcessPoolExecutor', ThreadPoolExecutor):      # NB: Keep the mocks in this process
+            matches = custom_pancreas._match_sourcefiles(sourcefiles, self.bidsmap, 'DICOM')
+        self.assertEqual(get_matching_run.call_count, 2)                                    # I.e. one call per unique fingerprint
+        self.assertEqual(list(matches), list(sourcefiles))
+        for source, sourcefile in sourcefiles.items():
+            run, datatype, index = matches[source]
+            self.assertEqual(run['provenance'], str(sourcefile))
+            self.assertEqual(datatype, 'anat' if source.name.startswith('T1w') else 'func')
+
+
+class TestConvertRuns(ConvertRunsTestCase):
+
+    plugin_name = 'custom_pancreas'
+
+    @staticmethod
+    def get_dynamicvalue(value, sourcefile, runtime):
+        return value.strip('<>') if runtime else value
+
+    def runitem(self, name: str, datatype: str, bidskeys: dict) -> tuple:
+        source = Path(self.tmpdir.name)/'raw'/name
+        return source, source/'001.dcm', {'provenance': str(source/'001.dcm'), 'bids': bidskeys, 'meta': {}}, datatype
+
+    def test_rungroups(self):
+        rungroups = self.rungroups('dwi', {'suffix': 'dwi'})
+        with mock.patch.object(custom_pancreas, 'get_dynamicvalue', create=True, side_effect=self.get_dynamicvalue):
+            with self.assertLogs(custom_pancreas.bidscoin.LOGGER, 'ERROR'):             # NB: The corrupt run fails, but the others are still converted
+                scanrows = custom_pancreas._convert_runs(rungroups, self.bidsmap, self.bidsses.parent, self.bidsses, 'sub-01', '', 'Philips')
+        self.assertEqual(scanrows, self.scanrows('dwi/sub-01_dwi.nii.gz'))
+        self.assertEqual(bids.load_json(self.bidsses/'func'/'sub-01_task-rest_run-2_bold.json')['TaskName'], 'rest')
+        self.assertTrue((self.bidsses/'dwi'/'sub-01_dwi.bval').is_file())
+
+
+if __name__ == '__main__':
+    unittest.main()
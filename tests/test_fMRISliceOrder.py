@@ -0,0 +1,29 @@
+import unittest
+
+import numpy as np
+
+from bidscoin.plugins import fMRISliceOrder
+
+
+class TestSliceOrder(unittest.TestCase):
+
+    def test_default(self):
+        np.testing.assert_array_equal(fMRISliceOrder.get_sliceorder(5, 'no', 1, 'default'), [0, 2, 4, 1, 3])
+        np.testing.assert_array_equal(fMRISliceOrder.get_sliceorder(14, 'yes', 2, 'default'), [[0, 2, 4, 6, 1, 3, 5], [7, 9, 11, 13, 8, 10, 12]])
+
+    def test_default_mbsense_not_ported(self):
+        with self.assertRaises(NotImplementedError):
+            fMRISliceOrder.get_sliceorder(12, 'yes', 2, 'default')      # 6 slices per band
+        with self.assertRaises(NotImplementedError):
+            fMRISliceOrder.get_sliceorder(20, 'yes', 2, 'default')      # An even number of slices per band
+
+
+class TestSliceTime(unittest.TestCase):
+
+    def test_mbsense(self):
+        slicetiming = fMRISliceOrder.slicetime(2.0, 10, MB_SENSE_factor=2)
+        np.testing.assert_allclose(slicetiming, [[0, 0.4, 0.8, 1.2, 1.6, 0, 0.4, 0.8, 1.2, 1.6]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from bidscoin import bids
+from bidscoin.plugins import philips2bids
+from tests.helpers import ConvertRunsTestCase, write_dicom
+
+
+class TestConvertRuns(ConvertRunsTestCase):
+
+    plugin_name = 'philips2bids'
+
+    def runitem(self, name: str, datatype: str, bidskeys: dict) -> tuple:
+        source     = Path(self.tmpdir.name)/'raw'/name
+        sourcefile = source/'001.dcm'
+        datasource = bids.DataSource(sourcefile, self.plugin, 'DICOM', datatype)
+        return source, sourcefile, {'provenance': str(sourcefile), 'bids': bidskeys, 'meta': {}, 'datasource': datasource}, datatype
+
+    def test_rungroups(self):
+        rungroups = self.rungroups('fmap', {'dir': 'AP', 'suffix': 'epi'})
+        with self.assertLogs(philips2bids.bidscoin.LOGGER, 'ERROR'):                    # NB: The corrupt run fails, but the others are still converted
+            scanrows, jsondatas = philips2bids._convert_runs(rungroups, self.plugin, self.bidsmap, self.bidsses.parent, self.bidsses, 'sub-01', '', 'Philips')
+        self.assertEqual(scanrows, self.scanrows('fmap/sub-01_dir-AP_epi.nii.gz'))
+        self.assertEqual(sorted(jsonfile.name for jsonfile in jsondatas), ['sub-01_dir-AP_epi.json', 'sub-01_task-rest_run-1_bold.json', 'sub-01_task-rest_run-2_bold.json'])
+        self.assertEqual(jsondatas[self.bidsses/'func'/'sub-01_task-rest_run-2_bold.json']['TaskName'], 'rest')
+
+
+class TestParticipants(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.bidsfolder = Path(self.tmpdir.name)
+
+    def test_new_subjects(self):
+        philips2bids._update_participants(self.bidsfolder, 'sub-01', 'ses-01', 'PAR', Path())
+        philips2bids._update_participants(self.bidsfolder, 'sub-02', 'ses-01', 'PAR', Path())
+        self.assertEqual((self.bidsfolder/'participants.tsv').read_text(), 'participant_id\tsession_id\nsub-01\tses-01\nsub-02\tses-01\n')
+        self.assertIn('session_id', bids.load_json(self.bidsfolder/'participants.json'))
+
+    def test_first_session(self):
+        philips2bids._update_participants(self.bidsfolder, 'sub-01', 'ses-01', 'PAR', Path())
+        philips2bids._update_participants(self.bidsfolder, 'sub-01', 'ses-02', 'PAR', Path())
+        self.assertEqual((self.bidsfolder/'participants.tsv').read_text(), 'participant_id\tsession_id\nsub-01\tses-01\n')
+
+    def test_empty_session(self):
+        (self.bidsfolder/'participants.tsv').write_text('participant_id\tsession_id\tage\nsub-01\tn/a\t30\nsub-02\tses-01\t40\n')
+        philips2bids._update_participants(self.bidsfolder, 'sub-01', 'ses-02', 'PAR', Path())
+        self.assertEqual((self.bidsfolder/'participants.tsv').read_text(), 'participant_id\tsession_id\tage\nsub-01\tses-02\t30\nsub-02\tses-01\t40\n')
+
+    def test_dicom(self):
+        dicomfile = write_dicom(self.bidsfolder/'source.dcm')
+        philips2bids._update_participants(self.bidsfolder, 'sub-01', '', 'DICOM', dicomfile)
+        self.assertEqual((self.bidsfolder/'participants.tsv').read_text().splitlines()[0], 'participant_id\tsex\tsize\tweight')
+
+
+class TestBidsmapper(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.session = Path(self.tmpdir.name)/'sub-01'
+        for series, seriesdescription in (('001', 'T1w'), ('002', 'rest'), ('003', 'T1w'), ('004', 'rest')):
+            (self.session/series).mkdir(parents=True)
+            write_dicom(self.session/series/'001.dcm', seriesdescription=seriesdescription)
+
+    @staticmethod
+    def get_matching_run(datasource, bidsmap, runtime=False):
+        return {'provenance': str(datasource.path), 'datasource': datasource}, 0
+
+    def test_fingerprint_dedup(self):
+        bidsmap  = {'Options': {'plugins': {'philips2bids': {}}}, 'DICOM': {}}
+        template = {'DICOM': {'anat': [{'properties': {'filename': '', 'nrfiles': None}, 'attributes': {'SeriesDescription': 'T1w'}}]}}
+        with mock.patch.object(bids, 'get_matching_run', side_effect=self.get_matching_run) as get_matching_run, \
+             mock.patch.object(bids, 'exist_run', return_value=False), \
+             mock.patch.object(bids, 'append_run') as append_run:
+            philips2bids.bidsmapper_plugin(self.session, bidsmap, bidsmap, template, {})
+        self.assertEqual(get_matching_run.call_count, 2)                            # I.e. one call per unique SeriesDescription
+        self.assertEqual([Path(call.args[1]['provenance']).parent.name for call in append_run.call_args_list], ['001', '002'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from bidscoin import bids
+from bidscoin.plugins import postfixPHILIPS
+
+
+class TestPostfixSidecar(unittest.TestCase):
+
+    def test_estimated_marker(self):
+        jsondata = {'EstimatedEffectiveEchoSpacing': 0.0003, 'EstimatedTotalReadoutTime': 0.03, 'PhaseEncodingDirection': 'j-'}
+        postfixPHILIPS.postfix_sidecar(Path('sub-01_bold.json'), jsondata)
+        self.assertEqual(jsondata['EffectiveEchoSpacing'], 0.0003)
+        self.assertEqual(jsondata['TotalReadoutTime'], 0.03)
+        self.assertEqual(jsondata['EstimatedTotalReadoutTime'], postfixPHILIPS.GENERATEDBY)
+        self.assertEqual(jsondata['PhaseEncodingDirection'], 'j-')
+
+    def test_estimated_removed(self):
+        jsondata = {'EstimatedTotalReadoutTime': 0.03, 'SeriesDescription': 'fmap_AP', 'PhaseEncodingDirection': 'j'}
+        postfixPHILIPS.postfix_sidecar(Path('sub-01_epi.json'), jsondata, estimated=None, phaseencoding='no match', overwrite=True)
+        self.assertEqual(jsondata, {'SeriesDescription': 'fmap_AP', 'PhaseEncodingDirection': 'AP', 'TotalReadoutTime': 0.03})
+
+    def test_phaseencoding_fallback(self):
+        jsondata = {'SeriesDescription': 'rest'}
+        postfixPHILIPS.postfix_sidecar(Path('sub-01_bold.json'), jsondata)
+        self.assertEqual(jsondata['PhaseEncodingDirection'], 'j')
+        jsondata = {'SeriesDescription': 'rest', 'PhaseEncodingDirection': 'j'}
+        postfixPHILIPS.postfix_sidecar(Path('sub-01_epi.json'), jsondata, estimated=None, phaseencoding='no match', overwrite=True)
+        self.assertEqual(jsondata['PhaseEncodingDirection'], 'no match')
+
+    def test_rerun(self):
+        jsondata = {'EstimatedEffectiveEchoSpacing': 0.0003, 'EstimatedTotalReadoutTime': 0.03, 'SeriesDescription': 'dwi_AP'}
+        postfixPHILIPS.postfix_sidecar(Path('sub-01_dwi.json'), jsondata)
+        processed = dict(jsondata)
+        postfixPHILIPS.postfix_sidecar(Path('sub-01_dwi.json'), jsondata)
+        self.assertEqual(jsondata, processed)
+        self.assertEqual(jsondata['EffectiveEchoSpacing'], 0.0003)
+
+
+class TestProcessSidecar(unittest.TestCase):
+
+    def test_needs_processing(self):
+        jsondata = {'EstimatedEffectiveEchoSpacing': 0.0003, 'SeriesDescription': 'dwi_AP'}
+        self.assertTrue(postfixPHILIPS._needs_processing(bids.dumps_json(jsondata), False))
+        postfixPHILIPS.postfix_sidecar(Path('sub-01_dwi.json'), jsondata)
+        self.assertFalse(postfixPHILIPS._needs_processing(bids.dumps_json(jsondata), False))
+        self.assertTrue(postfixPHILIPS._needs_processing(bids.dumps_json(jsondata), True))
+        self.assertTrue(postfixPHILIPS._needs_processing(bids.dumps_json({'SeriesDescription': 'rest'}), False))
+        self.assertFalse(postfixPHILIPS._needs_processing(bids.dumps_json({'SeriesDescription': 'rest_PA'}), False))
+
+    def test_rerun_skips(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jsonfile = Path(tmpdir)/'sub-01_dwi.json'
+            jsonfile.write_bytes(bids.dumps_json({'EstimatedTotalReadoutTime': 0.03, 'SeriesDescription': 'dwi_PA'}))
+            postfixPHILIPS._process_sidecar(jsonfile, False, {})
+            processed = jsonfile.read_bytes()
+            self.assertEqual(bids.load_json(jsonfile)['TotalReadoutTime'], 0.03)
+            mtime = jsonfile.stat().st_mtime_ns
+            postfixPHILIPS._process_sidecar(jsonfile, False, {})
+            self.assertEqual(jsonfile.read_bytes(), processed)
+            self.assertEqual(jsonfile.stat().st_mtime_ns, mtime)
+
+
+if __name__ == '__main__':
+    unittest.main()